@@ -0,0 +1,97 @@
+# Бенчмарк /api/license/validate: валидаций в секунду и p50/p99 задержки.
+# Запуск из корня репозитория:
+#   python benchmarks/bench_license_validate.py --licenses 100000 --requests 50000 --threads 8
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк API проверки лицензий")
+    parser.add_argument("--licenses", type=int, default=100000, help="ключей в базе")
+    parser.add_argument("--requests", type=int, default=50000, help="всего запросов")
+    parser.add_argument("--threads", type=int, default=8, help="параллельных клиентов")
+    parser.add_argument("--unknown-ratio", type=float, default=0.1, help="доля несуществующих ключей")
+    args = parser.parse_args()
+
+    # Отдельная временная база и фиктивный токен: main.py читает их при импорте
+    tmp_dir = tempfile.mkdtemp(prefix="valture-bench-")
+    os.environ["DB_FILE"] = os.path.join(tmp_dir, "transactions.db")
+    os.environ.setdefault("BOT_TOKEN", "0:bench")
+
+    import logging
+    import main as bot_main
+    bot_main.create_application()
+    logging.disable(logging.WARNING)
+    # Запись HWID в таблицу не измеряем
+    bot_main.write_hwid_to_sheet = lambda license_key, hwid: None
+
+    keys = [f"BENCH{i:027d}" for i in range(args.licenses)]
+    conn = sqlite3.connect(bot_main.DB_FILE)
+    conn.executemany(
+        "INSERT INTO transactions (payment_id, user_id, username, license_key, timestamp, payment_type, status) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        ((f"bench-{i}", str(i), f"user{i}", key, "2024-01-01 00:00:00", "crypto", "succeeded")
+         for i, key in enumerate(keys))
+    )
+    # HWID из таблицы считаем импортированными, иначе API не привязывает новые ключи
+    bot_main.set_sync_state(conn, "sheet_hwids_imported", "bench")
+    conn.commit()
+    conn.close()
+
+    started = time.perf_counter()
+    bot_main.load_license_index()
+    print(f"Индекс загружен: {args.licenses} ключей за {(time.perf_counter() - started) * 1000:.1f} мс")
+
+    client = bot_main.app.test_client()
+    rng = random.Random(42)
+    workload = []
+    for _ in range(args.requests):
+        if rng.random() < args.unknown_ratio:
+            workload.append((f"UNKNOWN{rng.randrange(args.requests):025d}", "hwid"))
+        else:
+            index = rng.randrange(args.licenses)
+            workload.append((keys[index], f"hwid-{index}"))
+
+    def validate(item):
+        license_key, hwid = item
+        t0 = time.perf_counter()
+        response = client.post("/api/license/validate", json={"license_key": license_key, "hwid": hwid})
+        elapsed = time.perf_counter() - t0
+        return elapsed, response.status_code
+
+    # Первый проход включает однократную привязку HWID (запись в SQLite),
+    # второй — установившийся режим повторных проверок при запуске приложения
+    for phase in ("привязка", "повторные проверки"):
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.threads) as pool:
+            results = list(pool.map(validate, workload))
+        total = time.perf_counter() - started
+
+        latencies = sorted(elapsed * 1000 for elapsed, _ in results)
+        statuses = {}
+        for _, status in results:
+            statuses[status] = statuses.get(status, 0) + 1
+
+        print(f"[{phase}] запросов: {len(results)}, потоков: {args.threads}, статусы: {statuses}")
+        print(f"[{phase}] валидаций/сек: {len(results) / total:.0f}")
+        print(f"[{phase}] p50: {percentile(latencies, 50):.3f} мс, p99: {percentile(latencies, 99):.3f} мс, "
+              f"max: {latencies[-1]:.3f} мс")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+# Бенчмарк времени импорта и старта main.py на основе `python -X importtime`.
+# Завершается с кодом 1, если медиана превышает порог — для проверки регрессий:
+#   python benchmarks/bench_startup.py --runs 5 --max-import-ms 100 --max-startup-ms 600
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMPORTTIME_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)")
+
+# Импорт модуля и полная сборка приложения (БД, бот, Flask) без сети и polling
+STARTUP_SNIPPET = (
+    "import time; t0 = time.perf_counter(); import main; "
+    "main.create_application(); print((time.perf_counter() - t0) * 1000)"
+)
+
+
+def run_importtime(env):
+    # Возвращает (суммарное время main в мкс, [(прямая зависимость main, мкс)])
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        cwd=ROOT, env=env, capture_output=True, text=True, check=True
+    )
+    # Дочерние модули выводятся перед родителем: копим вложенные строки
+    # до строки верхнего уровня и оставляем те, что относятся к main
+    children = []
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if not match:
+            continue
+        _, cumulative_us, indent, name = match.groups()
+        if len(indent) == 1:
+            if name == "main":
+                return int(cumulative_us), children
+            children = []
+        elif len(indent) == 3:
+            children.append((name, int(cumulative_us)))
+    raise RuntimeError("main не найден в выводе -X importtime")
+
+
+def run_startup(env):
+    result = subprocess.run(
+        [sys.executable, "-c", STARTUP_SNIPPET],
+        cwd=ROOT, env=env, capture_output=True, text=True, check=True
+    )
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк импорта и старта бота")
+    parser.add_argument("--runs", type=int, default=5, help="количество запусков (берётся медиана)")
+    parser.add_argument("--max-import-ms", type=float, default=100.0, help="порог для import main")
+    parser.add_argument("--max-startup-ms", type=float, default=600.0, help="порог для create_application()")
+    parser.add_argument("--top", type=int, default=10, help="сколько самых тяжёлых импортов показать")
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env.setdefault("BOT_TOKEN", "0:bench")
+    env["DB_FILE"] = os.path.join(tempfile.mkdtemp(prefix="valture-startup-"), "transactions.db")
+    # Как в проде: байткод main.py кэшируется после первого запуска, компиляцию не меряем
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+
+    import_samples = []
+    startup_samples = []
+    direct = []
+    for _ in range(args.runs):
+        main_us, direct = run_importtime(env)
+        import_samples.append(main_us / 1000)
+        startup_samples.append(run_startup(env))
+
+    import_ms = statistics.median(import_samples)
+    startup_ms = statistics.median(startup_samples)
+
+    direct.sort(key=lambda item: item[1], reverse=True)
+    print(f"Запусков: {args.runs}")
+    print(f"import main: медиана {import_ms:.1f} мс (порог {args.max_import_ms:.0f} мс)")
+    print(f"create_application(): медиана {startup_ms:.1f} мс (порог {args.max_startup_ms:.0f} мс)")
+    print("Самые тяжёлые импорты из main:")
+    for name, cumulative in direct[:args.top]:
+        print(f"  {name}: {cumulative / 1000:.1f} мс")
+
+    failed = False
+    if import_ms > args.max_import_ms:
+        print(f"РЕГРЕССИЯ: import main {import_ms:.1f} мс > {args.max_import_ms:.0f} мс")
+        failed = True
+    if startup_ms > args.max_startup_ms:
+        print(f"РЕГРЕССИЯ: старт {startup_ms:.1f} мс > {args.max_startup_ms:.0f} мс")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
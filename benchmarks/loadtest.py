@@ -0,0 +1,389 @@
+# Нагрузочное тестирование бота без внешних сервисов.
+# Поднимает локальные заглушки Bot API, CryptoBot и YooKassa, подменяет лист Google Sheets
+# и прогоняет сценарии пользователей с заданной параллельностью:
+#   crypto:   /start -> menu_pay -> pay_crypto_confirm -> pay_verify
+#   yookassa: /start -> menu_pay -> pay_yookassa_confirm -> yookassa_webhook -> pay_verify
+# Запуск из корня репозитория:
+#   python benchmarks/loadtest.py --users 200 --concurrency 16 \
+#       --latency bot=20,crypto=80,yookassa=120,sheets=300 --error-rate crypto=0.05
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from uuid import uuid4
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SERVICES = ("bot", "crypto", "yookassa", "sheets")
+
+
+class Fault:
+    # Задержка (мс, с разбросом ±25%) и доля ошибок для одной заглушки
+    def __init__(self, latency_ms=0.0, error_rate=0.0, seed=0):
+        self.latency_ms = latency_ms
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def apply(self):
+        with self.lock:
+            jitter = self.rng.uniform(0.75, 1.25)
+            failed = self.rng.random() < self.error_rate
+        if self.latency_ms:
+            time.sleep(self.latency_ms * jitter / 1000)
+        return failed
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Заголовки и тело уходят отдельными записями: без TCP_NODELAY keep-alive ловит задержку ACK
+    disable_nagle_algorithm = True
+    fake = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_params(self):
+        query = {k: v[0] for k, v in parse_qs(urlparse(self.path).query).items()}
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        if body:
+            if "json" in (self.headers.get("Content-Type") or ""):
+                query.update(json.loads(body))
+            elif "form-urlencoded" in (self.headers.get("Content-Type") or ""):
+                query.update({k: v[0] for k, v in parse_qs(body.decode()).items()})
+        return query
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_any(self):
+        params = self.read_params()
+        if self.fake.fault.apply():
+            self.send_json(500, self.fake.error_payload())
+            return
+        status, payload = self.fake.respond(self.command, urlparse(self.path).path, params)
+        self.send_json(status, payload)
+
+    do_GET = handle_any
+    do_POST = handle_any
+
+
+class FakeServer:
+    def __init__(self, fault):
+        self.fault = fault
+        handler = type(f"{type(self).__name__}Handler", (FakeHandler,), {"fake": self})
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def error_payload(self):
+        return {"ok": False, "error": "injected failure"}
+
+
+class FakeBotApi(FakeServer):
+    # Запоминает последний текст для каждого чата, чтобы отличать ответы с ошибкой
+    def __init__(self, fault):
+        super().__init__(fault)
+        self.last_text = {}
+        self.message_ids = iter(range(1, 10 ** 9))
+        self.lock = threading.Lock()
+
+    def error_payload(self):
+        return {"ok": False, "error_code": 500, "description": "Internal Server Error: injected failure"}
+
+    def respond(self, command, path, params):
+        method = path.rsplit("/", 1)[-1]
+        chat_id = int(params.get("chat_id", 0) or 0)
+        if method in ("sendMessage", "editMessageText"):
+            with self.lock:
+                self.last_text[chat_id] = params.get("text", "")
+        if method == "answerCallbackQuery":
+            return 200, {"ok": True, "result": True}
+        with self.lock:
+            message_id = next(self.message_ids)
+        return 200, {"ok": True, "result": {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "text": params.get("text", ""),
+        }}
+
+
+class FakeCryptoBot(FakeServer):
+    def __init__(self, fault):
+        super().__init__(fault)
+        self.invoice_ids = iter(range(1, 10 ** 9))
+        self.lock = threading.Lock()
+
+    def respond(self, command, path, params):
+        if path.endswith("/createInvoice"):
+            with self.lock:
+                invoice_id = next(self.invoice_ids)
+            return 200, {"ok": True, "result": {
+                "invoice_id": invoice_id,
+                "status": "active",
+                "pay_url": f"https://t.me/CryptoBot?start=IV{invoice_id}",
+            }}
+        if path.endswith("/getInvoices"):
+            invoice_id = int(params.get("invoice_ids", 0))
+            return 200, {"ok": True, "result": {"items": [{"invoice_id": invoice_id, "status": "paid"}]}}
+        return 404, {"ok": False, "error": "unknown method"}
+
+
+class FakeYooKassa(FakeServer):
+    def error_payload(self):
+        return {"type": "error", "id": str(uuid4()), "code": "internal_server_error",
+                "description": "injected failure"}
+
+    def payment(self, payment_id, status):
+        return {
+            "id": payment_id,
+            "status": status,
+            "paid": status == "succeeded",
+            "amount": {"value": "1000.00", "currency": "RUB"},
+            "confirmation": {"type": "redirect", "confirmation_url": f"https://yoomoney.ru/checkout/{payment_id}"},
+            "created_at": "2024-01-01T00:00:00.000Z",
+            "description": "Valture License",
+            "metadata": {},
+            "recipient": {"account_id": "1", "gateway_id": "1"},
+            "refundable": False,
+            "test": True,
+        }
+
+    def respond(self, command, path, params):
+        if command == "POST" and path.endswith("/payments"):
+            return 200, self.payment(str(uuid4()), "pending")
+        match = re.search(r"/payments/([^/]+)$", path)
+        if command == "GET" and match:
+            return 200, self.payment(match.group(1), "succeeded")
+        return 404, self.error_payload()
+
+
+class FakeSpreadsheet:
+    # Минимальная замена gspread.Spreadsheet: шарды-листы создаются по требованию
+    def __init__(self, fault):
+        self.fault = fault
+        self.worksheets = {}
+
+    def worksheet(self, title):
+        import gspread
+        if title not in self.worksheets:
+            raise gspread.exceptions.WorksheetNotFound(title)
+        return self.worksheets[title]
+
+    def add_worksheet(self, title, rows, cols):
+        self.worksheets[title] = FakeWorksheet(self.fault, title)
+        return self.worksheets[title]
+
+    @property
+    def sheet1(self):
+        return self.worksheets.get("Sheet1") or self.add_worksheet("Sheet1", 1000, 4)
+
+
+class FakeWorksheet:
+    # Минимальная замена gspread.Worksheet для append_license_to_sheet
+    def __init__(self, fault, title="Sheet1"):
+        self.fault = fault
+        self.title = title
+        self.rows = 0
+        self.lock = threading.Lock()
+
+    def append_row(self, values, **kwargs):
+        if self.fault.apply():
+            raise RuntimeError("injected Sheets failure")
+        with self.lock:
+            self.rows += 1
+            row = self.rows
+        return {"updates": {"updatedRange": f"'{self.title}'!A{row}:D{row}"}}
+
+
+def parse_per_service(value, option):
+    # "bot=20,crypto=80" -> {'bot': 20.0, 'crypto': 80.0}
+    result = {}
+    for item in filter(None, (value or "").split(",")):
+        service, _, number = item.partition("=")
+        if service not in SERVICES:
+            raise SystemExit(f"{option}: неизвестный сервис {service!r}, допустимы {', '.join(SERVICES)}")
+        result[service] = float(number)
+    return result
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class Recorder:
+    def __init__(self):
+        self.samples = {}
+        self.errors = {}
+        self.lock = threading.Lock()
+
+    def record(self, step, elapsed, ok):
+        with self.lock:
+            self.samples.setdefault(step, []).append(elapsed)
+            if not ok:
+                self.errors[step] = self.errors.get(step, 0) + 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочное тестирование бота на локальных заглушках")
+    parser.add_argument("--users", type=int, default=100, help="сколько сценариев прогнать")
+    parser.add_argument("--concurrency", type=int, default=8, help="параллельных пользователей")
+    parser.add_argument("--journeys", default="crypto,yookassa", help="сценарии через запятую")
+    parser.add_argument("--latency", default="", help="задержка заглушек в мс: bot=20,crypto=80,...")
+    parser.add_argument("--error-rate", default="", help="доля ошибок заглушек: crypto=0.05,...")
+    parser.add_argument("--state", default="sqlite", help="STATE_BACKEND: sqlite или memory")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    latency = parse_per_service(args.latency, "--latency")
+    error_rate = parse_per_service(args.error_rate, "--error-rate")
+    faults = {
+        service: Fault(latency.get(service, 0.0), error_rate.get(service, 0.0), seed=args.seed + i)
+        for i, service in enumerate(SERVICES)
+    }
+    journeys = [name for name in args.journeys.split(",") if name]
+    for name in journeys:
+        if name not in ("crypto", "yookassa"):
+            raise SystemExit(f"Неизвестный сценарий: {name}")
+
+    bot_api = FakeBotApi(faults["bot"])
+    cryptobot = FakeCryptoBot(faults["crypto"])
+    yookassa = FakeYooKassa(faults["yookassa"])
+
+    # main.py читает настройки из окружения при импорте
+    os.environ["DB_FILE"] = os.path.join(tempfile.mkdtemp(prefix="valture-load-"), "transactions.db")
+    os.environ["BOT_TOKEN"] = "0:loadtest"
+    os.environ["STATE_BACKEND"] = args.state
+    os.environ["TELEGRAM_API_URL"] = bot_api.url + "/bot{0}/{1}"
+    os.environ["CRYPTO_BOT_API"] = cryptobot.url + "/api"
+    os.environ["YOOKASSA_API_URL"] = yookassa.url + "/v3"
+    os.environ["YOOKASSA_SHOP_ID"] = "loadtest"
+    os.environ["YOOKASSA_SECRET_KEY"] = "loadtest"
+
+    import logging
+    import main as bot_main
+    from telebot import types
+    bot_main.create_application()
+    logging.disable(logging.WARNING)
+    bot_main.spreadsheet_cache = FakeSpreadsheet(faults["sheets"])
+    # Повторы записи в таблицу ждут по 2 с — в отчёте это видно как хвост pay_verify
+    recorder = Recorder()
+
+    def user_payload(user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"load{user_id}", "username": f"load{user_id}"}
+
+    def message_payload(user_id, text):
+        return {
+            "message_id": 1, "date": int(time.time()), "text": text,
+            "chat": {"id": user_id, "type": "private"}, "from": user_payload(user_id),
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(text)}],
+        }
+
+    def step(user_id, name, action):
+        # Действие может вернуть другое имя шага, чтобы исход попал в отдельную строку отчёта
+        bot_api.last_text.pop(user_id, None)
+        started = time.perf_counter()
+        try:
+            name = action() or name
+            ok = not bot_api.last_text.get(user_id, "").startswith("❌")
+        except Exception:
+            ok = False
+        recorder.record(name, time.perf_counter() - started, ok)
+        return ok
+
+    def callback(user_id, data):
+        call = types.CallbackQuery.de_json({
+            "id": str(uuid4()), "chat_instance": "load", "data": data,
+            "from": user_payload(user_id), "message": message_payload(user_id, "menu"),
+        })
+        return lambda: bot_main.button_handler(call)
+
+    def yookassa_webhook(user_id):
+        def send():
+            pending = bot_main.get_pending_invoice(user_id)
+            if pending is None:
+                raise RuntimeError("нет ожидающего платежа")
+            response = bot_main.app.test_client().post("/yookassa-webhook", json={
+                "event": "payment.succeeded",
+                "object": {"id": pending["payment_id"],
+                           "metadata": {"user_id": str(user_id), "username": f"load{user_id}"}},
+            })
+            status = (response.get_json(silent=True) or {}).get("status")
+            if status == "ignored":
+                # Платёж уже записан как pending при создании: вебхук ключ не выдаёт
+                return "yookassa_webhook:ignored"
+            if status != "ok":
+                raise RuntimeError(f"webhook {response.status_code}: {status}")
+        return send
+
+    def run_journey(index):
+        user_id = 100000 + index
+        journey = journeys[index % len(journeys)]
+        started = time.perf_counter()
+        message = types.Message.de_json(message_payload(user_id, "/start"))
+        steps = [
+            ("/start", lambda: bot_main.welcome(message)),
+            ("menu_pay", callback(user_id, "menu_pay")),
+        ]
+        if journey == "crypto":
+            steps.append(("pay_crypto_confirm", callback(user_id, "pay_crypto_confirm")))
+        else:
+            steps.append(("pay_yookassa_confirm", callback(user_id, "pay_yookassa_confirm")))
+            steps.append(("yookassa_webhook", yookassa_webhook(user_id)))
+        steps.append(("pay_verify", callback(user_id, "pay_verify")))
+
+        ok = True
+        for name, action in steps:
+            if not step(user_id, name, action):
+                ok = False
+                break
+        recorder.record(f"journey:{journey}", time.perf_counter() - started, ok)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(run_journey, range(args.users)))
+    total = time.perf_counter() - started
+
+    steps_done = sum(len(v) for k, v in recorder.samples.items() if not k.startswith("journey:"))
+    print(f"Сценариев: {args.users}, параллельно: {args.concurrency}, хранилище: {args.state}")
+    print(f"Задержки заглушек (мс): {latency or '-'}; доля ошибок: {error_rate or '-'}")
+    print(f"Время: {total:.2f} с, сценариев/сек: {args.users / total:.1f}, шагов/сек: {steps_done / total:.1f}")
+    print(f"{'шаг':<24}{'кол-во':>8}{'ошибок':>8}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}")
+    order = ["/start", "menu_pay", "pay_crypto_confirm", "pay_yookassa_confirm", "yookassa_webhook",
+             "yookassa_webhook:ignored", "pay_verify"]
+    names = [name for name in order if name in recorder.samples]
+    names += sorted(name for name in recorder.samples if name not in order)
+    for name in names:
+        values = sorted(elapsed * 1000 for elapsed in recorder.samples[name])
+        print(f"{name:<24}{len(values):>8}{recorder.errors.get(name, 0):>8}"
+              f"{percentile(values, 50):>10.1f}{percentile(values, 95):>10.1f}{percentile(values, 99):>10.1f}")
+    ignored = len(recorder.samples.get("yookassa_webhook:ignored", []))
+    if ignored:
+        print(f"Внимание: вебхук YooKassa не выдал ключ в {ignored} сценариях (status=ignored), "
+              "заказы выполнил pay_verify")
+
+
+if __name__ == "__main__":
+    main()
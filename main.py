@@ -1,19 +1,24 @@
-import telebot
-from telebot import types
-import requests
 import os
 import random
 import string
 from datetime import datetime, timezone, timedelta
-import gspread
-from google.oauth2.service_account import Credentials
 import logging
 import time
-from flask import Flask, request, jsonify
-from threading import Thread, Timer
+import re
+import sys
+from threading import Thread, Timer, Lock, get_ident
 from uuid import uuid4
-from yookassa import Configuration, Payment
+from collections import OrderedDict, Counter, deque
 import sqlite3
+import tempfile
+import csv
+import io
+import json
+import hmac
+import hashlib
+import socket
+import functools
+import importlib
 
 # --- Настройки ---
 # Цены, ссылка на приложение и новости
@@ -31,31 +36,73 @@ YOOKASSA_SHOP_ID = os.environ.get("YOOKASSA_SHOP_ID")
 YOOKASSA_SECRET_KEY = os.environ.get("YOOKASSA_SECRET_KEY")
 CREDS_FILE = os.environ.get("CREDS_FILE", "valture-license-bot-account.json")
 SPREADSHEET_NAME = os.environ.get("SPREADSHEET_NAME", "Valture_Licenses")
+DB_FILE = os.environ.get("DB_FILE", "transactions.db")
+# Telegram ID администраторов через запятую
+ADMIN_IDS = {int(x) for x in os.environ.get("ADMIN_IDS", "").split(",") if x.strip()}
+# Токен для админских HTTP-маршрутов (заголовок X-Admin-Token); без него маршруты отключены
+ADMIN_API_TOKEN = os.environ.get("ADMIN_API_TOKEN")
 TEST_PAYMENT_AMOUNT = 0.1  # TON для тестовых платежей CryptoBot
+PAYMENT_AMOUNTS = {'crypto': CRYPTO_AMOUNT, 'yookassa': YOOKASSA_AMOUNT}
 
 SCOPE = [
     "https://www.googleapis.com/auth/spreadsheets",
     "https://www.googleapis.com/auth/drive",
 ]
 
-CRYPTO_BOT_API = "https://pay.crypt.bot/api"
+# Адреса API провайдеров можно переопределить (стенды, нагрузочное тестирование)
+CRYPTO_BOT_API = os.environ.get("CRYPTO_BOT_API", "https://pay.crypt.bot/api")
+CRYPTO_BOT_TIMEOUT = 10  # секунд на запрос к CryptoBot
+YOOKASSA_API_URL = os.environ.get("YOOKASSA_API_URL")
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL")  # формат telebot: "http://host/bot{0}/{1}"
 
-# Configure YooKassa
-if YOOKASSA_SHOP_ID and YOOKASSA_SECRET_KEY:
-    Configuration.account_id = YOOKASSA_SHOP_ID
-    Configuration.secret_key = YOOKASSA_SECRET_KEY
+# Через сколько секунд после старта polling прогревать тяжёлые SDK
+WARMUP_DELAY = 2
+# Профилирование по запросу: куда писать collapsed-стеки и как часто снимать стек
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+PROFILE_SAMPLE_INTERVAL = 0.005
+PROFILE_MAX_SECONDS = 600
+# Предохранители внешних сервисов: окно последних вызовов, порог доли ошибок и пауза
+BREAKER_WINDOW = 20
+BREAKER_MIN_CALLS = 5
+BREAKER_FAILURE_RATE = 0.5
+BREAKER_OPEN_SECONDS = 30
+# Хранение незавершённых платежей: статус=дней в основной таблице, дальше — в архив.
+# succeeded не архивируется никогда, даже если указан.
+RETENTION_DAYS = os.environ.get("RETENTION_DAYS", "pending=7,canceled=30")
+ARCHIVE_DB_FILE = os.environ.get("ARCHIVE_DB_FILE")  # отдельная база для архива; по умолчанию — таблица в DB_FILE
+RETENTION_BATCH = 500  # строк за одну транзакцию переноса
+RETENTION_VACUUM_PAGES = 2000  # страниц, освобождаемых за один incremental_vacuum
+# Шардирование листа с ключами: none — всё в первый лист, как раньше; month — лист на месяц;
+# rows — новый лист каждые SHEET_SHARD_ROWS строк. Включать только после того, как всё,
+# что читает ключи из первого листа (клиент, поддержка), научится читать шарды.
+SHEET_SHARDING = os.environ.get("SHEET_SHARDING", "none")
+SHEET_SHARD_PREFIX = "Licenses"
+SHEET_SHARD_ROWS = int(os.environ.get("SHEET_SHARD_ROWS", "50000"))
+
+# --- Несколько экземпляров бота ---
+# Хранилище общего состояния: sqlite (один узел), redis (несколько узлов), memory (локально/тесты)
+STATE_BACKEND = os.environ.get("STATE_BACKEND", "sqlite")
+REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")  # для STATE_BACKEND=redis нужен пакет redis
+INSTANCE_ID = os.environ.get("INSTANCE_ID") or f"{socket.gethostname()}-{os.getpid()}"
+INVOICE_TTL = 1800  # 30 минут на оплату
+VERIFY_LOCK_TTL = 120  # блокировка проверки оплаты одного пользователя
+LEADER_LEASE_TTL = 30  # срок аренды лидера
+LEADER_RENEW_INTERVAL = 10  # как часто лидер продлевает аренду
+# Публичный адрес для вебхука Telegram. Если задан, бот не использует polling:
+# getUpdates допускает только один процесс, а вебхук может обслуживать любой экземпляр
+TELEGRAM_WEBHOOK_URL = os.environ.get("TELEGRAM_WEBHOOK_URL")
+TELEGRAM_WEBHOOK_SECRET = os.environ.get("TELEGRAM_WEBHOOK_SECRET") or hashlib.sha256(TOKEN.encode()).hexdigest()[:32]
 
 # --- Логирование ---
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.DEBUG
-)
+# Настраивается в create_application(), чтобы импорт модуля не имел побочных эффектов
 logger = logging.getLogger(__name__)
 
 # --- Инициализация SQLite ---
 def init_db():
-    conn = sqlite3.connect('transactions.db')
+    conn = sqlite3.connect(DB_FILE)
     cursor = conn.cursor()
+    # Действует только для новой базы; существующую переводит 'python main.py archive'
+    cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS transactions (
             payment_id TEXT PRIMARY KEY,
@@ -67,20 +114,104 @@ def init_db():
             status TEXT
         )
     ''')
+    # Служебное состояние фоновых задач (курсоры сверки и т.п.)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sync_state (
+            name TEXT PRIMARY KEY,
+            value TEXT
+        )
+    ''')
+    # Индекс ключей из Google Sheets: ключ -> лист/строка
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sheet_index (
+            license_key TEXT PRIMARY KEY,
+            worksheet TEXT,
+            row INTEGER
+        )
+    ''')
+    # Постраничный вывод лицензий пользователя (keyset по timestamp, rowid)
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_transactions_user_status
+        ON transactions (user_id, status, timestamp)
+    ''')
+    # Привязка ключа к HWID устройства (ключ привязывается один раз)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS license_bindings (
+            license_key TEXT PRIMARY KEY,
+            hwid TEXT NOT NULL,
+            bound_at TEXT
+        )
+    ''')
+    # Выпуски приложения: версия -> file_id документа в Telegram
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS releases (
+            version TEXT PRIMARY KEY,
+            file_id TEXT NOT NULL,
+            file_name TEXT,
+            published_at TEXT,
+            published_by TEXT
+        )
+    ''')
+    # Общее состояние экземпляров (STATE_BACKEND=sqlite): ожидающие оплаты, блокировки, аренда лидера
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS kv_state (
+            key TEXT PRIMARY KEY,
+            value TEXT,
+            expires_at REAL
+        )
+    ''')
+    # Агрегаты продаж: день × способ оплаты × статус. Каждая смена статуса
+    # платежа добавляет событие в свою ячейку, поэтому отчёты читают O(дней) строк.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sales_rollup (
+            day TEXT,
+            payment_type TEXT,
+            status TEXT,
+            count INTEGER NOT NULL DEFAULT 0,
+            amount REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, payment_type, status)
+        )
+    ''')
+    # Однократное построение агрегатов по уже накопленным транзакциям в тех же событиях,
+    # что пишет bump_sales_rollup(): pending при создании платежа и затем итоговый статус.
+    # Версия 1 считала только текущий статус и сумму для всех статусов — перестраиваем.
+    cursor.execute("SELECT value FROM sync_state WHERE name = 'sales_rollup_built'")
+    built = cursor.fetchone()
+    if built is None or built[0] != '2':
+        source = "SELECT timestamp, payment_type, status FROM transactions"
+        # Перенесённые в архив платежи (архив в той же базе) тоже были событиями
+        if cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'transactions_archive'"
+        ).fetchone():
+            source += " UNION ALL SELECT timestamp, payment_type, status FROM transactions_archive"
+        cursor.execute("DELETE FROM sales_rollup")
+        cursor.execute(f'''
+            INSERT INTO sales_rollup (day, payment_type, status, count, amount)
+            SELECT day, payment_type, status, SUM(count), SUM(amount) FROM (
+                SELECT substr(timestamp, 1, 10) AS day, payment_type, 'pending' AS status,
+                       COUNT(*) AS count, 0 AS amount
+                FROM ({source}) GROUP BY 1, 2
+                UNION ALL
+                SELECT substr(timestamp, 1, 10), payment_type, status, COUNT(*),
+                       CASE WHEN status = 'succeeded' THEN COUNT(*) *
+                            CASE payment_type WHEN 'crypto' THEN ? WHEN 'yookassa' THEN ? ELSE 0 END
+                       ELSE 0 END
+                FROM ({source}) WHERE status != 'pending' GROUP BY 1, 2, 3
+            ) GROUP BY 1, 2, 3
+        ''', (CRYPTO_AMOUNT, YOOKASSA_AMOUNT))
+        cursor.execute("INSERT OR REPLACE INTO sync_state (name, value) VALUES ('sales_rollup_built', '2')")
     conn.commit()
     conn.close()
 
-init_db()
-
 # --- Flask для keep-alive и вебхуков ---
-app = Flask(__name__)
+# Приложение создаётся в create_app(); маршруты регистрируются там же
+app = None
 
-@app.route('/')
 def home():
     return "✅ Valture бот работает!"
 
-@app.route('/yookassa-webhook', methods=['POST'])
 def yookassa_webhook():
+    from flask import request, jsonify
     try:
         event_json = request.get_json()
         logger.debug(f"YooKassa webhook received: {event_json}")
@@ -94,7 +225,7 @@ def yookassa_webhook():
         payment_id = payment_object['id']
         
         # Проверка, был ли платеж уже обработан
-        conn = sqlite3.connect('transactions.db')
+        conn = sqlite3.connect(DB_FILE)
         cursor = conn.cursor()
         cursor.execute("SELECT status FROM transactions WHERE payment_id = ?", (payment_id,))
         result = cursor.fetchone()
@@ -122,28 +253,33 @@ def yookassa_webhook():
                     INSERT INTO transactions (payment_id, user_id, username, license_key, timestamp, payment_type, status)
                     VALUES (?, ?, ?, ?, ?, ?, ?)
                 ''', (payment_id, user_id, username, license_key, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 'yookassa', 'succeeded'))
+                bump_sales_rollup(cursor, 'yookassa', 'succeeded')
                 conn.commit()
+                index_license(license_key, username)
                 
                 bot.send_message(
                     chat_id=user_id,
                     text=(
                         "🎉 *Поздравляем с покупкой!*\n\n"
                         f"Ваш лицензионный ключ:\n`{license_key}`\n\n"
-                        f"Скачать приложение Valture:\n[VALTURE.exe]({APP_DOWNLOAD_URL})\n\n"
+                        f"{app_download_text()}\n\n"
                         "Сохраните ключ и скачайте приложение! 🚀"
                     ),
                     parse_mode="Markdown",
                     disable_web_page_preview=True
                 )
+                send_app_release(user_id)
                 logger.info(f"YooKassa payment processed: {license_key} for {username}")
-                if user_id in invoices and invoices[user_id]['payment_type'] == 'yookassa':
-                    del invoices[user_id]
+                pending = get_pending_invoice(user_id)
+                if pending and pending['payment_type'] == 'yookassa':
+                    clear_pending_invoice(user_id)
             except Exception as e:
                 logger.error(f"Error processing YooKassa payment {payment_id}: {e}")
                 cursor.execute('''
                     INSERT INTO transactions (payment_id, user_id, username, timestamp, payment_type, status)
                     VALUES (?, ?, ?, ?, ?, ?)
                 ''', (payment_id, user_id, username, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 'yookassa', 'failed'))
+                bump_sales_rollup(cursor, 'yookassa', 'failed')
                 conn.commit()
                 bot.send_message(
                     chat_id=user_id,
@@ -162,6 +298,7 @@ def yookassa_webhook():
                 INSERT INTO transactions (payment_id, user_id, username, timestamp, payment_type, status)
                 VALUES (?, ?, ?, ?, ?, ?)
             ''', (payment_id, user_id or '', username or '', datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 'yookassa', 'canceled'))
+            bump_sales_rollup(cursor, 'yookassa', 'canceled')
             conn.commit()
             conn.close()
             return jsonify({"status": "ok"}), 200
@@ -173,30 +310,424 @@ def yookassa_webhook():
         logger.error(f"Error in YooKassa webhook: {e}")
         return jsonify({"status": "error", "message": str(e)}), 500
 
+def validate_license_api():
+    from flask import request, jsonify
+    payload = request.get_json(silent=True) or {}
+    license_key = str(payload.get('license_key') or '').strip()
+    hwid = str(payload.get('hwid') or '').strip()
+    if not license_key or not hwid or len(license_key) > 64 or len(hwid) > MAX_HWID_LENGTH:
+        return jsonify({"valid": False, "reason": "bad_request"}), 400
+
+    try:
+        entry = lookup_license(license_key)
+        if entry is None:
+            return jsonify({"valid": False, "reason": "not_found"}), 404
+
+        bound_hwid = entry['hwid']
+        if bound_hwid is None:
+            if not hwid_import_done():
+                # Ключ мог быть привязан до license_bindings: ждём импорта HWID из таблицы
+                return jsonify({"valid": False, "reason": "unavailable"}), 503
+            bound_hwid = bind_license_hwid(license_key, hwid)
+        if bound_hwid != hwid:
+            return jsonify({"valid": False, "reason": "hwid_mismatch"}), 403
+        return jsonify({"valid": True, "username": entry['username']}), 200
+    except Exception as e:
+        logger.error(f"Ошибка проверки лицензии {license_key}: {e}")
+        return jsonify({"valid": False, "reason": "error"}), 500
+
+def is_admin_request():
+    from flask import request
+    token = request.headers.get('X-Admin-Token', '')
+    return bool(ADMIN_API_TOKEN) and hmac.compare_digest(token, ADMIN_API_TOKEN)
+
+def admin_export():
+    from flask import request, jsonify, Response, stream_with_context
+    if not is_admin_request():
+        return jsonify({"status": "error", "message": "Forbidden"}), 403
+    export_format = request.args.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({"status": "error", "message": "Unknown format"}), 400
+    generator, mimetype, extension = EXPORT_FORMATS[export_format]
+    return Response(
+        stream_with_context(generator(since=request.args.get('since'))),
+        mimetype=mimetype,
+        headers={"Content-Disposition": f"attachment; filename=transactions.{extension}"}
+    )
+
+def admin_stats():
+    from flask import request, jsonify
+    if not is_admin_request():
+        return jsonify({"status": "error", "message": "Forbidden"}), 403
+    try:
+        days = int(request.args.get('days', 30))
+    except ValueError:
+        return jsonify({"status": "error", "message": "Invalid days"}), 400
+    if days < 1:
+        return jsonify({"status": "error", "message": "Invalid days"}), 400
+    rows = get_sales_rollup(days)
+    return jsonify([
+        {"day": day, "payment_type": payment_type, "status": status, "count": count, "amount": amount}
+        for day, payment_type, status, count, amount in rows
+    ])
+
+def admin_profile():
+    from flask import request, jsonify, Response
+    if not is_admin_request():
+        return jsonify({"status": "error", "message": "Forbidden"}), 403
+    if request.method == 'GET':
+        if request.args.get('format') == 'folded':
+            if last_profile_report is None:
+                return jsonify({"status": "error", "message": "No profile yet"}), 404
+            return Response(last_profile_report['folded'], mimetype='text/plain')
+        session = profile_session
+        return jsonify({
+            "active": session is not None,
+            "updates": session.updates if session else None,
+            "report": {k: v for k, v in (last_profile_report or {}).items() if k != 'folded'} or None,
+        })
+
+    payload = request.get_json(silent=True) or {}
+    if payload.get('stop'):
+        report = stop_profiling()
+        return jsonify({"status": "ok", "stopped": report is not None})
+    try:
+        max_updates = int(payload['updates']) if payload.get('updates') is not None else None
+        seconds = float(payload['seconds']) if payload.get('seconds') is not None else None
+        # Как и в /profile: ноль, отрицательные значения и nan не превращаются в PROFILE_MAX_SECONDS
+        if any(value is not None and not value > 0 for value in (max_updates, seconds)):
+            raise ValueError
+    except (TypeError, ValueError):
+        return jsonify({"status": "error", "message": "Invalid updates/seconds"}), 400
+    if not start_profiling(max_updates=max_updates, seconds=seconds):
+        return jsonify({"status": "error", "message": "Profiling already active"}), 409
+    return jsonify({"status": "ok"})
+
+def metrics():
+    from flask import Response
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+def create_app():
+    from flask import Flask
+    flask_app = Flask(__name__)
+    flask_app.add_url_rule('/', view_func=home)
+    flask_app.add_url_rule('/metrics', view_func=metrics)
+    flask_app.add_url_rule('/yookassa-webhook', view_func=profiled(yookassa_webhook), methods=['POST'])
+    flask_app.add_url_rule('/api/license/validate', view_func=profiled(validate_license_api), methods=['POST'])
+    flask_app.add_url_rule('/admin/export', view_func=admin_export)
+    flask_app.add_url_rule('/admin/stats', view_func=admin_stats)
+    flask_app.add_url_rule('/admin/profile', view_func=admin_profile, methods=['GET', 'POST'])
+    flask_app.add_url_rule('/telegram-webhook', view_func=telegram_webhook, methods=['POST'])
+    return flask_app
+
 def run_flask():
     port = int(os.environ.get("PORT", 8080))
     app.run(host="0.0.0.0", port=port)
 
+def telegram_webhook():
+    from flask import request, jsonify
+    from telebot import types
+    token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    if not hmac.compare_digest(token, TELEGRAM_WEBHOOK_SECRET):
+        return jsonify({"status": "error", "message": "Forbidden"}), 403
+    update = types.Update.de_json(request.get_data(as_text=True))
+    bot.process_new_updates([update])
+    return jsonify({"status": "ok"}), 200
+
 # --- Инициализация бота ---
-bot = telebot.TeleBot(TOKEN)
-invoices = {}
-sheet_cache = None
-
-# --- Очистка устаревших invoices ---
-def clean_old_invoices():
-    current_time = time.time()
-    expired = []
-    for user_id, invoice in invoices.items():
-        if current_time - invoice.get('created_at', current_time) > 1800:  # 30 минут
-            expired.append(user_id)
-    for user_id in expired:
-        del invoices[user_id]
-    logger.debug(f"Очищено {len(expired)} устаревших инвойсов")
-    # Планируем следующую очистку через 10 минут
-    Timer(600, clean_old_invoices).start()
-
-# Запускаем первую очистку
-Timer(600, clean_old_invoices).start()
+# Бот и хранилище состояния создаются в create_application()
+bot = None
+state = None
+spreadsheet_cache = None
+worksheet_cache = {}  # название листа -> gspread.Worksheet
+sheet_shard_cache = None  # (название текущего шарда, лист): append не тратит запросы на поиск листа
+sheet_shard_number = None  # номер текущего шарда в режиме rows
+
+# --- Общее состояние: ожидающие оплаты, блокировки, аренда лидера ---
+# Все реализации хранят JSON-значения с TTL и поддерживают аренду:
+# acquire(name, owner, ttl) захватывает свободную/просроченную аренду или продлевает свою.
+class MemoryStateBackend:
+    # Локальная замена для одного процесса и тестов
+    def __init__(self):
+        self.items = {}
+        self.lock = Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.get(key)
+            if item is None or item[1] < time.time():
+                return None
+            return json.loads(item[0])
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.items[key] = (json.dumps(value), time.time() + ttl)
+
+    def delete(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+    def acquire(self, name, owner, ttl):
+        with self.lock:
+            item = self.items.get(name)
+            if item is None or item[1] < time.time() or item[0] == owner:
+                self.items[name] = (owner, time.time() + ttl)
+                return True
+            return False
+
+    def release(self, name, owner):
+        with self.lock:
+            item = self.items.get(name)
+            if item is not None and item[0] == owner:
+                del self.items[name]
+
+    def sweep(self):
+        now = time.time()
+        with self.lock:
+            expired = [key for key, (_, expires_at) in self.items.items() if expires_at < now]
+            for key in expired:
+                del self.items[key]
+        return len(expired)
+
+class SQLiteStateBackend:
+    # Таблица kv_state в DB_FILE: общая для процессов одного узла
+    def __init__(self, db_file=None):
+        self.db_file = db_file or DB_FILE
+
+    def execute(self, query, params=()):
+        conn = sqlite3.connect(self.db_file, timeout=10)
+        try:
+            cursor = conn.execute(query, params)
+            result = cursor.fetchone(), cursor.rowcount
+            conn.commit()
+            return result
+        finally:
+            conn.close()
+
+    def get(self, key):
+        row, _ = self.execute(
+            "SELECT value FROM kv_state WHERE key = ? AND expires_at >= ?", (key, time.time())
+        )
+        return json.loads(row[0]) if row else None
+
+    def set(self, key, value, ttl):
+        self.execute(
+            "INSERT OR REPLACE INTO kv_state (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, json.dumps(value), time.time() + ttl)
+        )
+
+    def delete(self, key):
+        self.execute("DELETE FROM kv_state WHERE key = ?", (key,))
+
+    def acquire(self, name, owner, ttl):
+        # Один UPSERT: вставка или перехват только если аренда наша или просрочена
+        now = time.time()
+        _, rowcount = self.execute('''
+            INSERT INTO kv_state (key, value, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT (key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at
+            WHERE kv_state.value = excluded.value OR kv_state.expires_at < ?
+        ''', (name, owner, now + ttl, now))
+        return rowcount == 1
+
+    def release(self, name, owner):
+        self.execute("DELETE FROM kv_state WHERE key = ? AND value = ?", (name, owner))
+
+    def sweep(self):
+        _, rowcount = self.execute("DELETE FROM kv_state WHERE expires_at < ?", (time.time(),))
+        return rowcount
+
+class RedisStateBackend:
+    # Любое Redis-совместимое хранилище; client можно передать готовый (например, локальную замену)
+    RENEW_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('pexpire', KEYS[1], ARGV[2]) else return 0 end"
+    RELEASE_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) else return 0 end"
+
+    def __init__(self, url=None, client=None, prefix="valture:"):
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url or REDIS_URL, decode_responses=True)
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return json.loads(value) if value is not None else None
+
+    def set(self, key, value, ttl):
+        self.client.set(self.prefix + key, json.dumps(value), px=int(ttl * 1000))
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def acquire(self, name, owner, ttl):
+        key = self.prefix + name
+        if self.client.set(key, owner, nx=True, px=int(ttl * 1000)):
+            return True
+        return bool(self.client.eval(self.RENEW_SCRIPT, 1, key, owner, int(ttl * 1000)))
+
+    def release(self, name, owner):
+        self.client.eval(self.RELEASE_SCRIPT, 1, self.prefix + name, owner)
+
+    def sweep(self):
+        # Redis удаляет просроченные ключи сам
+        return 0
+
+STATE_BACKENDS = {
+    'memory': MemoryStateBackend,
+    'sqlite': SQLiteStateBackend,
+    'redis': RedisStateBackend,
+}
+
+def create_state_backend(name=None):
+    name = name or STATE_BACKEND
+    if name not in STATE_BACKENDS:
+        raise ValueError(f"Неизвестный STATE_BACKEND: {name}")
+    logger.info(f"Хранилище состояния: {name}, экземпляр {INSTANCE_ID}")
+    if name == 'redis':
+        # Ожидающие оплаты видны всем экземплярам, а строки платежей — только тому, чья это база
+        logger.warning(f"STATE_BACKEND=redis: {DB_FILE} должен быть общим для всех экземпляров, "
+                       "иначе проверка оплаты на другом экземпляре завершится ошибкой")
+    return STATE_BACKENDS[name]()
+
+def get_pending_invoice(user_id):
+    return state.get(f"invoice:{user_id}")
+
+def set_pending_invoice(user_id, invoice):
+    state.set(f"invoice:{user_id}", invoice, INVOICE_TTL)
+
+def clear_pending_invoice(user_id):
+    state.delete(f"invoice:{user_id}")
+
+# --- Хранение и архивирование транзакций ---
+# Брошенные оплаты (pending/canceled) переносятся в transactions_archive пачками:
+# каждая пачка — отдельная транзакция BEGIN IMMEDIATE, поэтому запись новых платежей
+# ждёт не дольше одной пачки. Условие status != 'succeeded' AND license_key IS NULL
+# повторяется в INSERT и DELETE, так что выданная лицензия не попадёт в архив,
+# даже если статус сменился между выборкой и переносом.
+ARCHIVE_COLUMNS = "payment_id, user_id, username, license_key, timestamp, payment_type, status"
+
+def parse_retention_days(value=None):
+    days = {}
+    for item in filter(None, (value if value is not None else RETENTION_DAYS).split(",")):
+        status, _, number = item.strip().partition("=")
+        if status == 'succeeded':
+            logger.warning("RETENTION_DAYS: succeeded не архивируется, пропущено")
+            continue
+        days[status] = int(number)
+    return days
+
+def archive_stale_transactions(retention=None, batch=RETENTION_BATCH, now=None, convert_vacuum=False):
+    retention = parse_retention_days() if retention is None else retention
+    now = now or datetime.now()
+    conn = sqlite3.connect(DB_FILE, timeout=30, isolation_level=None)
+    moved = {}
+    try:
+        schema = 'main'
+        if ARCHIVE_DB_FILE:
+            conn.execute("ATTACH DATABASE ? AS archive", (ARCHIVE_DB_FILE,))
+            schema = 'archive'
+        conn.execute(f'''
+            CREATE TABLE IF NOT EXISTS {schema}.transactions_archive (
+                payment_id TEXT PRIMARY KEY,
+                user_id TEXT,
+                username TEXT,
+                license_key TEXT,
+                timestamp TEXT,
+                payment_type TEXT,
+                status TEXT,
+                archived_at TEXT
+            )
+        ''')
+
+        archived_at = now.strftime("%Y-%m-%d %H:%M:%S")
+        for status, days in retention.items():
+            if status == 'succeeded':
+                continue
+            cutoff = (now - timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
+            moved[status] = 0
+            while True:
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    rowids = [row[0] for row in conn.execute(
+                        "SELECT rowid FROM transactions WHERE status = ? AND timestamp < ? "
+                        "AND license_key IS NULL LIMIT ?",
+                        (status, cutoff, batch)
+                    )]
+                    if not rowids:
+                        conn.execute("COMMIT")
+                        break
+                    placeholders = ", ".join("?" * len(rowids))
+                    guard = f"rowid IN ({placeholders}) AND status != 'succeeded' AND license_key IS NULL"
+                    conn.execute(
+                        f"INSERT OR REPLACE INTO {schema}.transactions_archive ({ARCHIVE_COLUMNS}, archived_at) "
+                        f"SELECT {ARCHIVE_COLUMNS}, ? FROM transactions WHERE {guard}",
+                        [archived_at] + rowids
+                    )
+                    deleted = conn.execute(f"DELETE FROM transactions WHERE {guard}", rowids).rowcount
+                    conn.execute("COMMIT")
+                except Exception:
+                    conn.execute("ROLLBACK")
+                    raise
+                moved[status] += deleted
+                if len(rowids) < batch:
+                    break
+
+        # Освобождаем страницы постепенно. Полный VACUUM держит исключительную блокировку
+        # всё время перестройки, поэтому базу без auto_vacuum переводят только явно из CLI.
+        if conn.execute("PRAGMA main.auto_vacuum").fetchone()[0] != 2:
+            if convert_vacuum:
+                logger.info("Перевод базы в auto_vacuum=INCREMENTAL (однократный VACUUM)")
+                conn.execute("PRAGMA main.auto_vacuum = INCREMENTAL")
+                conn.execute("VACUUM main")
+            else:
+                logger.warning("База без auto_vacuum=INCREMENTAL: место не освобождается, "
+                               "выполните 'python main.py archive' в окно обслуживания")
+        conn.execute(f"PRAGMA main.incremental_vacuum({RETENTION_VACUUM_PAGES})")
+        free_pages = conn.execute("PRAGMA main.freelist_count").fetchone()[0]
+    finally:
+        conn.close()
+
+    logger.info(f"Архивировано транзакций: {moved}, свободных страниц осталось: {free_pages}")
+    return {'moved': moved, 'free_pages': free_pages}
+
+# --- Фоновые задачи и выбор лидера ---
+# Фоновые задачи выполняет только экземпляр, удерживающий аренду 'leader'.
+# Отметка job:<имя> с TTL = интервал не даёт задаче повториться сразу после смены лидера.
+is_leader = False
+
+def clean_expired_state():
+    removed = state.sweep()
+    logger.debug(f"Очищено {removed} устаревших записей состояния")
+
+# (имя, интервал в секундах, функция)
+BACKGROUND_JOBS = [
+    ('clean_expired_state', 600, clean_expired_state),
+    ('archive_stale_transactions', 3600, archive_stale_transactions),
+]
+
+def run_due_jobs():
+    for name, interval, job in BACKGROUND_JOBS:
+        # Уникальный владелец: отметку нельзя «продлить», только дождаться её истечения
+        if not state.acquire(f"job:{name}", f"{INSTANCE_ID}:{time.time()}", interval):
+            continue
+        try:
+            job()
+        except Exception as e:
+            logger.error(f"Ошибка фоновой задачи {name}: {e}")
+
+def leader_loop():
+    global is_leader
+    while True:
+        try:
+            leader_now = state.acquire('leader', INSTANCE_ID, LEADER_LEASE_TTL)
+            if leader_now != is_leader:
+                logger.info(f"Экземпляр {INSTANCE_ID} {'стал лидером' if leader_now else 'больше не лидер'}")
+            is_leader = leader_now
+            if is_leader:
+                run_due_jobs()
+        except Exception as e:
+            is_leader = False
+            logger.error(f"Ошибка выбора лидера: {e}")
+        time.sleep(LEADER_RENEW_INTERVAL)
 
 # --- Обработка Google Sheets ---
 def setup_google_creds():
@@ -206,14 +737,16 @@ def setup_google_creds():
         raise FileNotFoundError(f"Файл {CREDS_FILE} не найден")
     logger.info(f"Используется файл учетных данных: {CREDS_FILE}")
 
-def get_sheet():
-    global sheet_cache
-    if sheet_cache is None:
+def get_spreadsheet():
+    global spreadsheet_cache
+    if spreadsheet_cache is None:
+        import gspread
+        from google.oauth2.service_account import Credentials
         try:
             setup_google_creds()
             creds = Credentials.from_service_account_file(CREDS_FILE, scopes=SCOPE)
             client = gspread.authorize(creds)
-            sheet_cache = client.open(SPREADSHEET_NAME).sheet1
+            spreadsheet_cache = client.open(SPREADSHEET_NAME)
             logger.info(f"Подключено к Google Sheet: {SPREADSHEET_NAME}")
         except gspread.exceptions.SpreadsheetNotFound:
             logger.error(f"Google Sheet '{SPREADSHEET_NAME}' не найдена")
@@ -221,7 +754,78 @@ def get_sheet():
         except Exception as e:
             logger.error(f"Ошибка подключения к Google Sheets: {str(e)}")
             raise
-    return sheet_cache
+    return spreadsheet_cache
+
+def get_worksheet(title, create=False):
+    worksheet = worksheet_cache.get(title)
+    if worksheet is not None:
+        return worksheet
+    import gspread
+    spreadsheet = get_spreadsheet()
+    try:
+        worksheet = spreadsheet.worksheet(title)
+    except gspread.exceptions.WorksheetNotFound:
+        if not create:
+            raise
+        try:
+            worksheet = spreadsheet.add_worksheet(title=title, rows=100, cols=4)
+            logger.info(f"Создан лист {title}")
+        except gspread.exceptions.APIError:
+            # Лист мог создать другой экземпляр одновременно с нами
+            worksheet = spreadsheet.worksheet(title)
+    worksheet_cache[title] = worksheet
+    return worksheet
+
+def get_shard_number():
+    global sheet_shard_number
+    if sheet_shard_number is None:
+        conn = sqlite3.connect(DB_FILE)
+        try:
+            sheet_shard_number = int(get_sync_state(conn, 'sheet_shard', 1))
+        finally:
+            conn.close()
+    return sheet_shard_number
+
+def current_shard_title(now=None):
+    if SHEET_SHARDING == 'month':
+        now = now or datetime.now(timezone(timedelta(hours=2)))
+        return f"{SHEET_SHARD_PREFIX} {now.strftime('%Y-%m')}"
+    if SHEET_SHARDING == 'rows':
+        return f"{SHEET_SHARD_PREFIX} {get_shard_number():03d}"
+    return None
+
+def get_sheet():
+    # Лист, в который сейчас дописываются ключи
+    return get_shard_worksheet(current_shard_title())
+
+def get_shard_worksheet(title):
+    # Выбор шарда кэшируется и пересчитывается без запросов к API,
+    # пока не сменится месяц или номер шарда
+    global sheet_shard_cache
+    if sheet_shard_cache is None or sheet_shard_cache[0] != title:
+        worksheet = get_worksheet(title, create=True) if title else get_spreadsheet().sheet1
+        sheet_shard_cache = (title, worksheet)
+    return sheet_shard_cache[1]
+
+def rotate_sheet_shard(last_row):
+    # Режим rows: после заполнения шарда следующий append уйдёт в новый лист
+    global sheet_shard_number
+    if SHEET_SHARDING != 'rows' or last_row is None or last_row < SHEET_SHARD_ROWS:
+        return
+    conn = sqlite3.connect(DB_FILE)
+    try:
+        # Другой экземпляр мог уже переключить шард — номер только растёт
+        stored = int(get_sync_state(conn, 'sheet_shard', 1))
+        number = max(stored, get_shard_number() + 1)
+        set_sync_state(conn, 'sheet_shard', number)
+        conn.commit()
+    finally:
+        conn.close()
+    sheet_shard_number = number
+    logger.info(f"Шард {SHEET_SHARD_PREFIX} заполнен ({last_row} строк), следующий: {number:03d}")
+
+def is_admin(user_id):
+    return user_id in ADMIN_IDS
 
 def generate_license(length=32):
     try:
@@ -233,29 +837,499 @@ def generate_license(length=32):
         raise
 
 def append_license_to_sheet(license_key, username, retries=3, delay=2):
+    # Номер шарда читается из SQLite — вне повторов и предохранителя Sheets
+    try:
+        title = current_shard_title()
+    except sqlite3.Error as e:
+        logger.error(f"Не удалось выбрать лист для ключа {license_key}: {e}")
+        return False
     for attempt in range(1, retries + 1):
+        # При открытом предохранителе не ждём повторов: ключ дозапишет сверка (/reconcile)
+        if not sheets_breaker.allow():
+            logger.warning(f"Google Sheets недоступен, ключ {license_key} не записан")
+            return False
         try:
-            sheet = get_sheet()
+            sheet = get_shard_worksheet(title)
             utc_plus_2 = timezone(timedelta(hours=2))
             now_utc_plus_2 = datetime.now(utc_plus_2)
             now_str = now_utc_plus_2.strftime("%Y-%m-%d %H:%M:%S")
-            sheet.append_row([license_key, "", username, now_str])
-            logger.info(f"HWID-ключ {license_key} добавлен для {username}")
-            return True
+            response = sheet.append_row([license_key, "", username, now_str])
         except Exception as e:
+            sheets_breaker.record(success=not is_provider_failure(e))
             logger.error(f"Попытка {attempt}/{retries} не удалась: {str(e)}")
             if attempt < retries:
                 time.sleep(delay)
+            continue
+        # Строка уже в таблице: дальше только локальный учёт, его ошибки не повторяют append
+        sheets_breaker.record(success=True)
+        logger.info(f"HWID-ключ {license_key} добавлен для {username}")
+        record_sheet_rows(sheet.title, [license_key], response)
+        try:
+            rotate_sheet_shard(parse_updated_row(response))
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка переключения шарда после {license_key}: {e}")
+        return True
     logger.error(f"Не удалось добавить ключ {license_key} после {retries} попыток")
     return False
 
+def parse_updated_row(response):
+    # Ответ append: {'updates': {'updatedRange': "'Sheet1'!A5:D7", ...}} -> 5
+    try:
+        updated_range = response['updates']['updatedRange']
+    except (TypeError, KeyError):
+        return None
+    match = re.search(r'![A-Z]+(\d+)', updated_range)
+    return int(match.group(1)) if match else None
+
+def record_sheet_rows(worksheet, license_keys, response, conn=None):
+    first_row = parse_updated_row(response)
+    if first_row is None:
+        return
+    own_conn = conn is None
+    try:
+        if own_conn:
+            conn = sqlite3.connect(DB_FILE)
+        conn.executemany(
+            "INSERT OR REPLACE INTO sheet_index (license_key, worksheet, row) VALUES (?, ?, ?)",
+            [(key, worksheet, first_row + offset) for offset, key in enumerate(license_keys)]
+        )
+        conn.commit()
+    except Exception as e:
+        # Индекс вспомогательный: сверка восстановит его при следующем запуске
+        logger.error(f"Ошибка записи индекса листа: {e}")
+    finally:
+        if own_conn and conn is not None:
+            conn.close()
+
+# --- Сверка Google Sheets и SQLite ---
+RECONCILE_READ_CHUNK = 5000  # строк за один запрос чтения
+RECONCILE_WRITE_BATCH = 500  # строк за один append_rows
+reconcile_lock = Lock()
+
+def get_sync_state(conn, name, default=None):
+    row = conn.execute("SELECT value FROM sync_state WHERE name = ?", (name,)).fetchone()
+    return row[0] if row else default
+
+def set_sync_state(conn, name, value):
+    conn.execute("INSERT OR REPLACE INTO sync_state (name, value) VALUES (?, ?)", (name, str(value)))
+
+def index_sheet_rows(sheet, conn, chunk=RECONCILE_READ_CHUNK):
+    # Читаем колонки с ключом и HWID диапазонами по chunk строк, начиная с сохранённого курсора.
+    # Курсор коммитится после каждого диапазона, поэтому прерванная сверка продолжится с того же места.
+    # У каждого листа-шарда свой курсор.
+    state_name = f"reconcile_cursor:{sheet.title}"
+    last_row = int(get_sync_state(conn, state_name, 0))
+    # Размер сетки берётся из свежего списка листов: чтение за её пределами API отклоняет
+    row_count = sheet.row_count
+    indexed = 0
+    while last_row < row_count:
+        start = last_row + 1
+        end = min(start + chunk - 1, row_count)
+        values = sheet.get(f"A{start}:B{end}")
+        if not values:
+            break
+        entries = [
+            (row[0].strip(), sheet.title, start + offset)
+            for offset, row in enumerate(values)
+            if row and row[0].strip()
+        ]
+        conn.executemany(
+            "INSERT OR REPLACE INTO sheet_index (license_key, worksheet, row) VALUES (?, ?, ?)",
+            entries
+        )
+        # HWID, привязанные до появления license_bindings, хранятся только в колонке B
+        seed_license_bindings(conn, [
+            (row[0].strip(), row[1].strip())
+            for row in values
+            if len(row) > 1 and row[0].strip() and row[1].strip()
+        ])
+        last_row = start + len(values) - 1
+        set_sync_state(conn, state_name, last_row)
+        conn.commit()
+        indexed += len(entries)
+        logger.debug(f"Сверка: проиндексированы строки {start}-{last_row} листа {sheet.title}")
+        # Значения обрезаются по последней непустой строке — дальше данных нет
+        if last_row < end:
+            break
+    return indexed, last_row
+
+def backfill_missing_licenses(conn, batch=RECONCILE_WRITE_BATCH):
+    # Недостающие ключи дописываются в текущий шард.
+    # Keyset по rowid: каждая пачка — отдельный короткий запрос, без открытого курсора во время записи
+    last_rowid = 0
+    backfilled = 0
+    while True:
+        rows = conn.execute('''
+            SELECT t.rowid, t.license_key, t.username, t.timestamp FROM transactions t
+            LEFT JOIN sheet_index s ON s.license_key = t.license_key
+            WHERE t.status = 'succeeded' AND t.license_key IS NOT NULL
+              AND s.license_key IS NULL AND t.rowid > ?
+            ORDER BY t.rowid LIMIT ?
+        ''', (last_rowid, batch)).fetchall()
+        if not rows:
+            break
+        last_rowid = rows[-1][0]
+        sheet = get_sheet()
+        response = sheet.append_rows([[key, "", username or "", timestamp or ""] for _, key, username, timestamp in rows])
+        record_sheet_rows(sheet.title, [key for _, key, _, _ in rows], response, conn=conn)
+        first_row = parse_updated_row(response)
+        rotate_sheet_shard(first_row + len(rows) - 1 if first_row else None)
+        backfilled += len(rows)
+        logger.info(f"Сверка: дозаписано {len(rows)} ключей в {sheet.title}")
+    return backfilled
+
+def reconcile_sheet(full=False):
+    if not reconcile_lock.acquire(blocking=False):
+        logger.warning("Сверка уже выполняется")
+        return None
+    conn = sqlite3.connect(DB_FILE)
+    try:
+        # Один запрос на список листов: сверяются все шарды и старый первый лист
+        worksheets = get_spreadsheet().worksheets()
+        # Первая сверка после появления импорта HWID перечитывает листы целиком
+        imported = get_sync_state(conn, 'sheet_hwids_imported') is not None
+        full = full or not imported
+        if full:
+            conn.execute("DELETE FROM sync_state WHERE name LIKE 'reconcile_cursor:%'")
+            conn.execute("DELETE FROM sheet_index")
+            conn.commit()
+        indexed = 0
+        last_rows = {}
+        for sheet in worksheets:
+            sheet_indexed, last_rows[sheet.title] = index_sheet_rows(sheet, conn)
+            indexed += sheet_indexed
+        if not imported:
+            set_sync_state(conn, 'sheet_hwids_imported', datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+            conn.commit()
+            logger.info("HWID из таблицы импортированы в license_bindings")
+        backfilled = backfill_missing_licenses(conn)
+        result = {'indexed': indexed, 'last_rows': last_rows, 'backfilled': backfilled}
+        logger.info(f"Сверка завершена: {result}")
+        return result
+    finally:
+        conn.close()
+        reconcile_lock.release()
+
+# --- Индекс лицензий для API проверки ---
+NEGATIVE_CACHE_SIZE = 10000  # сколько несуществующих ключей помнить
+MAX_HWID_LENGTH = 128
+license_index = {}  # license_key -> {'username': ..., 'hwid': ...}
+license_negative_cache = OrderedDict()
+license_index_lock = Lock()
+license_index_loaded = False
+license_index_load_lock = Lock()  # при холодном старте индекс загружает один запрос, остальные ждут
+sheet_hwids_imported = False
+
+def load_license_index():
+    global license_index_loaded
+    conn = sqlite3.connect(DB_FILE)
+    try:
+        rows = conn.execute('''
+            SELECT t.license_key, t.username, b.hwid FROM transactions t
+            LEFT JOIN license_bindings b ON b.license_key = t.license_key
+            WHERE t.status = 'succeeded' AND t.license_key IS NOT NULL
+        ''')
+        index = {key: {'username': username, 'hwid': hwid} for key, username, hwid in rows}
+    finally:
+        conn.close()
+    with license_index_lock:
+        license_index.clear()
+        license_index.update(index)
+        license_negative_cache.clear()
+        license_index_loaded = True
+    logger.info(f"Индекс лицензий загружен: {len(index)} ключей")
+
+def index_license(license_key, username):
+    # Вызывается при выдаче ключа, чтобы он сразу проходил проверку
+    with license_index_lock:
+        license_index[license_key] = {'username': username, 'hwid': None}
+        license_negative_cache.pop(license_key, None)
+
+def lookup_license(license_key):
+    if not license_index_loaded:
+        with license_index_load_lock:
+            if not license_index_loaded:
+                load_license_index()
+    entry = license_index.get(license_key)
+    if entry is not None:
+        return entry
+    with license_index_lock:
+        if license_key in license_negative_cache:
+            license_negative_cache.move_to_end(license_key)
+            return None
+
+    # Промах: ключ мог быть выдан другим процессом после загрузки индекса
+    conn = sqlite3.connect(DB_FILE)
+    try:
+        row = conn.execute('''
+            SELECT t.username, b.hwid FROM transactions t
+            LEFT JOIN license_bindings b ON b.license_key = t.license_key
+            WHERE t.license_key = ? AND t.status = 'succeeded'
+        ''', (license_key,)).fetchone()
+    finally:
+        conn.close()
+
+    with license_index_lock:
+        if row:
+            entry = {'username': row[0], 'hwid': row[1]}
+            license_index[license_key] = entry
+            return entry
+        license_negative_cache[license_key] = True
+        if len(license_negative_cache) > NEGATIVE_CACHE_SIZE:
+            license_negative_cache.popitem(last=False)
+    return None
+
+def seed_license_bindings(conn, pairs):
+    # Привязки из таблицы не перезаписывают уже сохранённые в SQLite
+    if not pairs:
+        return
+    bound_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    conn.executemany(
+        "INSERT OR IGNORE INTO license_bindings (license_key, hwid, bound_at) VALUES (?, ?, ?)",
+        [(key, hwid, bound_at) for key, hwid in pairs]
+    )
+    with license_index_lock:
+        for key, hwid in pairs:
+            entry = license_index.get(key)
+            if entry is not None and entry['hwid'] is None:
+                entry['hwid'] = hwid
+
+def hwid_import_done():
+    # Пока HWID из колонки B не импортированы, новая привязка может отдать чужое устройство
+    global sheet_hwids_imported
+    if not sheet_hwids_imported:
+        conn = sqlite3.connect(DB_FILE)
+        try:
+            sheet_hwids_imported = get_sync_state(conn, 'sheet_hwids_imported') is not None
+        finally:
+            conn.close()
+    return sheet_hwids_imported
+
+def restore_sheet_binding(license_key, bound_hwid, sheet_hwid):
+    # В таблице уже другой HWID: привязка из таблицы старше, возвращаем её
+    conn = sqlite3.connect(DB_FILE)
+    try:
+        conn.execute(
+            "UPDATE license_bindings SET hwid = ? WHERE license_key = ? AND hwid = ?",
+            (sheet_hwid, license_key, bound_hwid)
+        )
+        conn.commit()
+    finally:
+        conn.close()
+    with license_index_lock:
+        entry = license_index.get(license_key)
+        if entry is not None and entry['hwid'] == bound_hwid:
+            entry['hwid'] = sheet_hwid
+    logger.error(f"Ключ {license_key} уже привязан в таблице к {sheet_hwid}, привязка к {bound_hwid} отменена")
+
+def bind_license_hwid(license_key, hwid):
+    # INSERT OR IGNORE по первичному ключу атомарен: при гонке побеждает первый запрос,
+    # остальные читают уже сохранённый HWID. Возвращает HWID, к которому привязан ключ.
+    conn = sqlite3.connect(DB_FILE)
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "INSERT OR IGNORE INTO license_bindings (license_key, hwid, bound_at) VALUES (?, ?, ?)",
+            (license_key, hwid, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+        )
+        bound_now = cursor.rowcount == 1
+        if not bound_now:
+            hwid = cursor.execute(
+                "SELECT hwid FROM license_bindings WHERE license_key = ?", (license_key,)
+            ).fetchone()[0]
+        conn.commit()
+    finally:
+        conn.close()
+
+    with license_index_lock:
+        entry = license_index.get(license_key)
+        if entry is not None:
+            entry['hwid'] = hwid
+    if bound_now:
+        logger.info(f"Ключ {license_key} привязан к HWID {hwid}")
+        Thread(target=write_hwid_to_sheet, args=(license_key, hwid), daemon=True).start()
+    return hwid
+
+def write_hwid_to_sheet(license_key, hwid):
+    # Копия для людей: ошибки не влияют на проверку, источник истины — SQLite
+    if not sheets_breaker.allow():
+        logger.warning(f"Google Sheets недоступен, HWID для {license_key} не записан")
+        return
+    try:
+        conn = sqlite3.connect(DB_FILE)
+        try:
+            row = conn.execute(
+                "SELECT worksheet, row FROM sheet_index WHERE license_key = ?", (license_key,)
+            ).fetchone()
+        finally:
+            conn.close()
+        sheet = None
+        if row:
+            # Таблицу правят вручную: после удаления или сортировки строк номер из индекса
+            # указывает на чужой ключ, поэтому сначала сверяем колонку A
+            indexed_sheet = get_worksheet(row[0])
+            values = indexed_sheet.get(f"A{row[1]}:B{row[1]}")
+            if values and values[0] and values[0][0] == license_key:
+                sheet, row_number = indexed_sheet, row[1]
+            else:
+                logger.warning(f"Строка {row[1]} листа {row[0]} больше не содержит ключ {license_key}")
+        if sheet is None:
+            # Ключ не проиндексирован или строка сместилась: ищем по шардам, начиная с последних
+            cell = None
+            for sheet in reversed(get_spreadsheet().worksheets()):
+                cell = sheet.find(license_key, in_column=1)
+                if cell is not None:
+                    break
+            if cell is None:
+                # Запросы find прошли успешно — сообщаем это предохранителю (важно для пробного вызова)
+                sheets_breaker.record(success=True)
+                logger.warning(f"Ключ {license_key} не найден в таблице, HWID не записан")
+                return
+            row_number = cell.row
+            values = sheet.get(f"A{row_number}:B{row_number}")
+            conn = sqlite3.connect(DB_FILE)
+            try:
+                conn.execute(
+                    "INSERT OR REPLACE INTO sheet_index (license_key, worksheet, row) VALUES (?, ?, ?)",
+                    (license_key, sheet.title, row_number)
+                )
+                conn.commit()
+            finally:
+                conn.close()
+        sheet_hwid = values[0][1].strip() if values and len(values[0]) > 1 else ''
+        if sheet_hwid and sheet_hwid != hwid:
+            # Чужой HWID в таблице не перезаписываем
+            sheets_breaker.record(success=True)
+            restore_sheet_binding(license_key, hwid, sheet_hwid)
+            return
+        if sheet_hwid != hwid:
+            sheet.update_cell(row_number, 2, hwid)
+        sheets_breaker.record(success=True)
+        logger.info(f"HWID для {license_key} записан в таблицу ({sheet.title}, строка {row_number})")
+    except Exception as e:
+        sheets_breaker.record(success=not is_provider_failure(e))
+        logger.error(f"Ошибка записи HWID для {license_key} в таблицу: {e}")
+
+# --- Предохранители (circuit breakers) внешних сервисов ---
+# closed: вызовы идут, исходы копятся в окне; при доле ошибок >= порога -> open.
+# open: вызовы сразу отклоняются BREAKER_OPEN_SECONDS; затем half_open.
+# half_open: пропускается один пробный вызов — успех закрывает, ошибка снова открывает.
+SERVICE_UNAVAILABLE_ERROR = "сервис временно недоступен, попробуйте позже"
+BREAKER_STATES = {'closed': 0, 'half_open': 1, 'open': 2}
+
+class CircuitBreaker:
+    def __init__(self, name, window=BREAKER_WINDOW, min_calls=BREAKER_MIN_CALLS,
+                 failure_rate=BREAKER_FAILURE_RATE, open_seconds=BREAKER_OPEN_SECONDS):
+        self.name = name
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.open_seconds = open_seconds
+        self.outcomes = deque(maxlen=window)
+        self.state = 'closed'
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+        self.trial_started_at = 0.0
+        self.counters = {'success': 0, 'failure': 0, 'rejected': 0, 'opened': 0}
+        self.lock = Lock()
+
+    def available(self):
+        # Без изменения состояния: для меню, где нужно лишь решить, показывать ли кнопку
+        with self.lock:
+            return self.state != 'open' or time.time() - self.opened_at >= self.open_seconds
+
+    def allow(self):
+        with self.lock:
+            if self.state == 'open' and time.time() - self.opened_at >= self.open_seconds:
+                self.state = 'half_open'
+                self.trial_in_flight = False
+                logger.info(f"Предохранитель {self.name}: half_open")
+            # Пробный вызов, не сообщивший результат за open_seconds, считается потерянным
+            if (self.state == 'half_open' and self.trial_in_flight
+                    and time.time() - self.trial_started_at >= self.open_seconds):
+                self.trial_in_flight = False
+            if self.state == 'closed' or (self.state == 'half_open' and not self.trial_in_flight):
+                if self.state == 'half_open':
+                    self.trial_in_flight = True
+                    self.trial_started_at = time.time()
+                return True
+            self.counters['rejected'] += 1
+            return False
+
+    def record(self, success):
+        with self.lock:
+            self.counters['success' if success else 'failure'] += 1
+            if self.state == 'half_open':
+                if success:
+                    self.state = 'closed'
+                    self.outcomes.clear()
+                    logger.info(f"Предохранитель {self.name}: closed")
+                else:
+                    self.trip()
+                return
+            self.outcomes.append(success)
+            failures = self.outcomes.count(False)
+            if (self.state == 'closed' and len(self.outcomes) >= self.min_calls
+                    and failures / len(self.outcomes) >= self.failure_rate):
+                self.trip()
+
+    def trip(self):
+        self.state = 'open'
+        self.opened_at = time.time()
+        self.trial_in_flight = False
+        self.outcomes.clear()
+        self.counters['opened'] += 1
+        logger.warning(f"Предохранитель {self.name}: open на {self.open_seconds} с")
+
+def is_provider_failure(error):
+    # Сбой сервиса — сеть, таймаут, 5xx или 429; ошибки запроса (4xx) сервис исправен
+    if isinstance(error, sqlite3.Error):
+        return False  # локальная база, а не внешний сервис
+    status = getattr(error, 'HTTP_CODE', None)
+    if status is None:
+        status = getattr(getattr(error, 'response', None), 'status_code', None)
+    return status is None or status >= 500 or status == 429
+
+crypto_breaker = CircuitBreaker('crypto')
+yookassa_breaker = CircuitBreaker('yookassa')
+sheets_breaker = CircuitBreaker('sheets')
+BREAKERS = (crypto_breaker, yookassa_breaker, sheets_breaker)
+
+def render_metrics():
+    # Формат Prometheus text exposition
+    lines = [
+        "# HELP valture_circuit_breaker_state 0=closed, 1=half_open, 2=open",
+        "# TYPE valture_circuit_breaker_state gauge",
+    ]
+    for breaker in BREAKERS:
+        lines.append(f'valture_circuit_breaker_state{{dependency="{breaker.name}"}} {BREAKER_STATES[breaker.state]}')
+    lines += [
+        "# HELP valture_circuit_breaker_calls_total Calls by outcome (rejected = failed fast while open)",
+        "# TYPE valture_circuit_breaker_calls_total counter",
+    ]
+    for breaker in BREAKERS:
+        for outcome in ('success', 'failure', 'rejected'):
+            lines.append(
+                f'valture_circuit_breaker_calls_total{{dependency="{breaker.name}",outcome="{outcome}"}} '
+                f'{breaker.counters[outcome]}'
+            )
+    lines += [
+        "# HELP valture_circuit_breaker_opened_total Times the breaker opened",
+        "# TYPE valture_circuit_breaker_opened_total counter",
+    ]
+    for breaker in BREAKERS:
+        lines.append(f'valture_circuit_breaker_opened_total{{dependency="{breaker.name}"}} {breaker.counters["opened"]}')
+    return "\n".join(lines) + "\n"
+
 # --- Платежные функции ---
 def create_crypto_invoice(amount, asset="TON", description="Valture License"):
     logger.debug(f"Создание инвойса: amount={amount}, asset={asset}")
     if not CRYPTOBOT_API_TOKEN:
         logger.error("CRYPTOBOT_API_TOKEN не задан")
         return None, "CRYPTOBOT_API_TOKEN не задан"
+    if not crypto_breaker.allow():
+        return None, SERVICE_UNAVAILABLE_ERROR
     try:
+        import requests
         payload = {
             "amount": str(amount),
             "asset": asset,
@@ -266,10 +1340,11 @@ def create_crypto_invoice(amount, asset="TON", description="Valture License"):
             "Crypto-Pay-API-Token": CRYPTOBOT_API_TOKEN,
             "Content-Type": "application/json"
         }
-        response = requests.post(f"{CRYPTO_BOT_API}/createInvoice", json=payload, headers=headers, timeout=10)
+        response = requests.post(f"{CRYPTO_BOT_API}/createInvoice", json=payload, headers=headers, timeout=CRYPTO_BOT_TIMEOUT)
         logger.debug(f"HTTP статус: {response.status_code}, Ответ: {response.text}")
         response.raise_for_status()
         data = response.json()
+        crypto_breaker.record(success=True)
         if data.get("ok"):
             logger.info(f"Инвойс создан: invoice_id={data['result']['invoice_id']}")
             return data["result"], None
@@ -278,17 +1353,22 @@ def create_crypto_invoice(amount, asset="TON", description="Valture License"):
             logger.error(f"Ошибка API CryptoBot: {error_msg}")
             return None, f"Ошибка API: {error_msg}"
     except Exception as e:
+        crypto_breaker.record(success=not is_provider_failure(e))
         logger.error(f"Ошибка создания инвойса: {e}")
         return None, f"Ошибка: {str(e)}"
 
 def check_invoice_status(invoice_id):
     logger.debug(f"Проверка инвойса: invoice_id={invoice_id}")
+    if not crypto_breaker.allow():
+        return None
     try:
+        import requests
         headers = {"Crypto-Pay-API-Token": CRYPTOBOT_API_TOKEN}
-        response = requests.get(f"{CRYPTO_BOT_API}/getInvoices?invoice_ids={invoice_id}", headers=headers, timeout=10)
+        response = requests.get(f"{CRYPTO_BOT_API}/getInvoices?invoice_ids={invoice_id}", headers=headers, timeout=CRYPTO_BOT_TIMEOUT)
         logger.debug(f"HTTP статус: {response.status_code}, Ответ: {response.text}")
         response.raise_for_status()
         data = response.json()
+        crypto_breaker.record(success=True)
         if data.get("ok"):
             status = data["result"]["items"][0]["status"]
             logger.info(f"Статус инвойса {invoice_id}: {status}")
@@ -297,15 +1377,33 @@ def check_invoice_status(invoice_id):
             logger.error(f"Ошибка проверки: {data.get('error', 'Неизвестная ошибка')}")
             return None
     except Exception as e:
+        crypto_breaker.record(success=not is_provider_failure(e))
         logger.error(f"Ошибка проверки инвойса: {e}")
         return None
 
+yookassa_configured = False
+
+def get_yookassa_payment():
+    # SDK YooKassa импортируется и настраивается при первом обращении
+    global yookassa_configured
+    from yookassa import Configuration, Payment
+    if not yookassa_configured and YOOKASSA_SHOP_ID and YOOKASSA_SECRET_KEY:
+        Configuration.account_id = YOOKASSA_SHOP_ID
+        Configuration.secret_key = YOOKASSA_SECRET_KEY
+        if YOOKASSA_API_URL:
+            Configuration.api_url = YOOKASSA_API_URL
+        yookassa_configured = True
+    return Payment
+
 def create_yookassa_payment(amount, description, user_id, username):
     logger.debug(f"Создание YooKassa платежа: amount={amount}, user_id={user_id}")
     if not YOOKASSA_SHOP_ID or not YOOKASSA_SECRET_KEY:
         logger.error("YOOKASSA_SHOP_ID или YOOKASSA_SECRET_KEY не заданы")
         return None, "YooKassa credentials not configured"
+    if not yookassa_breaker.allow():
+        return None, SERVICE_UNAVAILABLE_ERROR
     try:
+        Payment = get_yookassa_payment()
         idempotence_key = str(uuid4())
         payment = Payment.create({
             "amount": {
@@ -323,26 +1421,469 @@ def create_yookassa_payment(amount, description, user_id, username):
                 "username": username
             }
         }, idempotence_key)
+        yookassa_breaker.record(success=True)
         logger.info(f"YooKassa платеж создан: payment_id={payment.id}")
         return payment, None
     except Exception as e:
+        yookassa_breaker.record(success=not is_provider_failure(e))
         logger.error(f"Ошибка создания YooKassa платежа: {e}")
         return None, f"YooKassa ошибка: {str(e)}"
 
 def check_yookassa_payment_status(payment_id):
     logger.debug(f"Проверка YooKassa платежа: payment_id={payment_id}")
+    if not yookassa_breaker.allow():
+        return None
     try:
-        payment = Payment.find_one(payment_id)
+        payment = get_yookassa_payment().find_one(payment_id)
+        yookassa_breaker.record(success=True)
         status = payment.status
         logger.info(f"Статус платежа {payment_id}: {status}")
         return status
     except Exception as e:
+        yookassa_breaker.record(success=not is_provider_failure(e))
         logger.error(f"Ошибка проверки YooKassa платежа: {e}")
         return None
 
+# --- Отчёты: выгрузка транзакций и агрегаты продаж ---
+EXPORT_COLUMNS = ['payment_id', 'user_id', 'username', 'license_key', 'timestamp', 'payment_type', 'status']
+EXPORT_BATCH = 1000
+
+def bump_sales_rollup(cursor, payment_type, status, timestamp=None):
+    # Вызывается в той же транзакции, что и запись статуса платежа.
+    # count — число событий смены статуса, amount — только выручка (succeeded).
+    day = (timestamp or datetime.now().strftime("%Y-%m-%d %H:%M:%S"))[:10]
+    amount = PAYMENT_AMOUNTS.get(payment_type, 0) if status == 'succeeded' else 0
+    cursor.execute('''
+        INSERT INTO sales_rollup (day, payment_type, status, count, amount) VALUES (?, ?, ?, 1, ?)
+        ON CONFLICT (day, payment_type, status)
+        DO UPDATE SET count = count + 1, amount = amount + excluded.amount
+    ''', (day, payment_type, status, amount))
+
+def get_sales_rollup(days=30):
+    since = (datetime.now() - timedelta(days=days - 1)).strftime("%Y-%m-%d")
+    conn = sqlite3.connect(DB_FILE)
+    try:
+        return conn.execute(
+            "SELECT day, payment_type, status, count, amount FROM sales_rollup "
+            "WHERE day >= ? ORDER BY day DESC, payment_type, status",
+            (since,)
+        ).fetchall()
+    finally:
+        conn.close()
+
+def iter_transactions(since=None, batch=EXPORT_BATCH):
+    # Keyset по rowid: короткий запрос на каждую пачку, чтобы долгая выгрузка
+    # не держала блокировку чтения и не мешала записи новых платежей
+    last_rowid = 0
+    while True:
+        conn = sqlite3.connect(DB_FILE)
+        try:
+            query = f"SELECT rowid, {', '.join(EXPORT_COLUMNS)} FROM transactions WHERE rowid > ?"
+            params = [last_rowid]
+            if since:
+                query += " AND timestamp >= ?"
+                params.append(since)
+            query += " ORDER BY rowid LIMIT ?"
+            params.append(batch)
+            rows = conn.execute(query, params).fetchall()
+        finally:
+            conn.close()
+        if not rows:
+            return
+        last_rowid = rows[-1][0]
+        for row in rows:
+            yield row[1:]
+
+def iter_transactions_csv(since=None):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    for row in iter_transactions(since):
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+def iter_transactions_ndjson(since=None):
+    for row in iter_transactions(since):
+        yield json.dumps(dict(zip(EXPORT_COLUMNS, row)), ensure_ascii=False) + "\n"
+
+# формат -> (генератор, mimetype, расширение файла)
+EXPORT_FORMATS = {
+    'csv': (iter_transactions_csv, 'text/csv', 'csv'),
+    'ndjson': (iter_transactions_ndjson, 'application/x-ndjson', 'ndjson'),
+}
+
+def format_sales_stats(rows, days):
+    if not rows:
+        return f"📊 За последние {days} дн. продаж нет."
+    totals = {}
+    daily = {}
+    for day, payment_type, status, count, amount in rows:
+        total = totals.setdefault((payment_type, status), [0, 0.0])
+        total[0] += count
+        total[1] += amount
+        if status == 'succeeded':
+            daily.setdefault(day, []).append(f"{payment_type} {count} ({amount:.2f})")
+
+    text = f"📊 Продажи за {days} дн.\n\n"
+    for (payment_type, status), (count, amount) in sorted(totals.items()):
+        text += f"{payment_type} / {status}: {count}"
+        if status == 'succeeded':
+            text += f", сумма {amount:.2f}"
+        text += "\n"
+    if daily:
+        text += "\nУспешные по дням:\n"
+        for day in sorted(daily, reverse=True):
+            text += f"{day}: {', '.join(daily[day])}\n"
+    return text
+
+# --- Купленные лицензии: постраничный вывод ---
+LICENSES_PAGE_SIZE = 5
+
+def encode_licenses_cursor(direction, timestamp, rowid):
+    # callback_data ограничена 64 байтами: "lic_next:20240101120000:12345"
+    ts_digits = re.sub(r'\D', '', timestamp)
+    return f"lic_{direction}:{ts_digits}:{rowid}"
+
+def decode_licenses_cursor(data):
+    prefix, ts_digits, rowid = data.split(':')
+    timestamp = datetime.strptime(ts_digits, "%Y%m%d%H%M%S").strftime("%Y-%m-%d %H:%M:%S")
+    return prefix[len('lic_'):], (timestamp, int(rowid))
+
+def fetch_licenses_page(user_id, cursor_key=None, direction='next', page_size=LICENSES_PAGE_SIZE):
+    # Новые покупки первыми. 'next' — страница старше курсора, 'prev' — новее.
+    # Берём на одну строку больше, чтобы узнать, есть ли следующая страница.
+    query = "SELECT rowid, license_key, timestamp, payment_type FROM transactions WHERE user_id = ? AND status = 'succeeded'"
+    params = [user_id]
+    if cursor_key is not None and direction == 'prev':
+        query += " AND (timestamp, rowid) > (?, ?) ORDER BY timestamp ASC, rowid ASC LIMIT ?"
+        params += [cursor_key[0], cursor_key[1], page_size + 1]
+    elif cursor_key is not None:
+        query += " AND (timestamp, rowid) < (?, ?) ORDER BY timestamp DESC, rowid DESC LIMIT ?"
+        params += [cursor_key[0], cursor_key[1], page_size + 1]
+    else:
+        query += " ORDER BY timestamp DESC, rowid DESC LIMIT ?"
+        params.append(page_size + 1)
+
+    conn = sqlite3.connect(DB_FILE)
+    try:
+        rows = conn.execute(query, params).fetchall()
+    finally:
+        conn.close()
+
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    if cursor_key is not None and direction == 'prev':
+        return rows[::-1], has_more, True
+    return rows, cursor_key is not None, has_more
+
+def render_licenses_page(user_id, cursor_key=None, direction='next'):
+    from telebot import types
+    rows, has_newer, has_older = fetch_licenses_page(user_id, cursor_key, direction)
+    markup = types.InlineKeyboardMarkup()
+    if not rows:
+        markup.add(types.InlineKeyboardButton(text="🔙 Назад в главное меню", callback_data='menu_main'))
+        return "У вас нет купленных ключей.", markup
+
+    response = "🔑 *Ваши покупки:*\n\n"
+    for _, key, timestamp, payment_type in rows:
+        response += (
+            f"Ключ: `{key}`\n"
+            f"Дата покупки: {timestamp}\n"
+            f"Тип: {payment_type.capitalize()}\n\n"
+        )
+
+    navigation = []
+    if has_newer:
+        first_rowid, _, first_ts, _ = rows[0]
+        navigation.append(types.InlineKeyboardButton(
+            text="⬅️ Новее", callback_data=encode_licenses_cursor('prev', first_ts, first_rowid)))
+    if has_older:
+        last_rowid, _, last_ts, _ = rows[-1]
+        navigation.append(types.InlineKeyboardButton(
+            text="Старее ➡️", callback_data=encode_licenses_cursor('next', last_ts, last_rowid)))
+    if navigation:
+        markup.row(*navigation)
+    markup.add(types.InlineKeyboardButton(text="📄 Скачать все ключи файлом", callback_data='lic_file'))
+    markup.add(types.InlineKeyboardButton(text="🔙 Назад в главное меню", callback_data='menu_main'))
+    return response, markup
+
+def send_licenses_file(chat_id):
+    # Строки пишутся во временный файл по мере чтения курсора — без fetchall
+    conn = sqlite3.connect(DB_FILE)
+    try:
+        rows = conn.execute(
+            "SELECT license_key, timestamp, payment_type FROM transactions "
+            "WHERE user_id = ? AND status = 'succeeded' ORDER BY timestamp DESC, rowid DESC",
+            (chat_id,)
+        )
+        count = 0
+        with tempfile.TemporaryFile() as f:
+            for key, timestamp, payment_type in rows:
+                f.write(f"{key}\t{timestamp}\t{payment_type}\n".encode('utf-8'))
+                count += 1
+            if not count:
+                return False
+            f.seek(0)
+            bot.send_document(
+                chat_id,
+                f,
+                visible_file_name="valture_licenses.txt",
+                caption=f"🔑 Ваши ключи: {count}"
+            )
+    finally:
+        conn.close()
+    logger.info(f"Выгружено {count} ключей для {chat_id}")
+    return True
+
+# --- Выпуски приложения: VALTURE.exe через Telegram ---
+# Файл загружается в Telegram один раз при публикации, дальше покупателям
+# уходит сохранённый file_id. Без опубликованного выпуска — ссылка APP_DOWNLOAD_URL.
+RELEASE_FILE_NAME = "VALTURE.exe"
+RELEASE_CACHE_TTL = 60  # другие экземпляры увидят новый выпуск не позже чем через минуту
+release_cache = None  # (время загрузки, выпуск или None)
+
+def get_current_release():
+    global release_cache
+    if release_cache and time.monotonic() - release_cache[0] < RELEASE_CACHE_TTL:
+        return release_cache[1]
+    conn = sqlite3.connect(DB_FILE)
+    try:
+        row = conn.execute('''
+            SELECT version, file_id, file_name FROM releases
+            WHERE version = (SELECT value FROM sync_state WHERE name = 'current_release')
+        ''').fetchone()
+    finally:
+        conn.close()
+    release = {'version': row[0], 'file_id': row[1], 'file_name': row[2]} if row else None
+    release_cache = (time.monotonic(), release)
+    return release
+
+def publish_release(version, file_id, file_name=RELEASE_FILE_NAME, published_by=None):
+    global release_cache
+    conn = sqlite3.connect(DB_FILE)
+    try:
+        conn.execute('''
+            INSERT OR REPLACE INTO releases (version, file_id, file_name, published_at, published_by)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (version, file_id, file_name, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), published_by))
+        set_sync_state(conn, 'current_release', version)
+        conn.commit()
+    finally:
+        conn.close()
+    release_cache = None
+    logger.info(f"Опубликован выпуск {version}: {file_name}")
+    return {'version': version, 'file_id': file_id, 'file_name': file_name}
+
+def upload_release(version, path, chat_id, published_by=None):
+    # Единственная загрузка файла: Telegram возвращает file_id отправленного документа
+    file_name = os.path.basename(path)
+    with open(path, 'rb') as f:
+        sent = bot.send_document(chat_id, f, visible_file_name=file_name, caption=f"Valture {version}")
+    return publish_release(version, sent.document.file_id, file_name, published_by)
+
+def app_download_text():
+    # Текст идёт в сообщение об уже выданном ключе: ошибка чтения выпуска не должна его сорвать
+    try:
+        release = get_current_release()
+    except Exception as e:
+        logger.error(f"Не удалось прочитать текущий выпуск: {e}")
+        release = None
+    if release:
+        return f"Приложение Valture {release['version']} — файлом в следующем сообщении 👇"
+    return f"Скачать приложение Valture:\n[VALTURE.exe]({APP_DOWNLOAD_URL})"
+
+def send_app_release(chat_id):
+    try:
+        release = get_current_release()
+    except Exception as e:
+        logger.error(f"Не удалось прочитать текущий выпуск: {e}")
+        release = None
+    if release is None:
+        return False
+    try:
+        bot.send_document(chat_id, release['file_id'], caption=f"Valture {release['version']}")
+        return True
+    except Exception as e:
+        logger.error(f"Не удалось отправить выпуск {release['version']} в {chat_id}: {e}")
+        bot.send_message(
+            chat_id,
+            f"Скачать приложение Valture:\n[VALTURE.exe]({APP_DOWNLOAD_URL})",
+            parse_mode="Markdown",
+            disable_web_page_preview=True
+        )
+        return False
+
+# --- Профилирование по запросу ---
+# Обработчики регистрируются через profiled(): пока профилирование выключено,
+# обёртка сводится к одной проверке глобальной переменной.
+# Во время сессии для каждого вызова копится время по обработчику и по call.data
+# (до первого ':' — курсоры страниц не плодят отдельные строки), а фоновый поток
+# снимает стеки потоков, занятых обработчиками, в формат collapsed для flamegraph.
+profile_session = None
+last_profile_report = None
+profile_lock = Lock()
+
+class ProfileSession:
+    def __init__(self, max_updates=None, seconds=None, notify_chat_id=None):
+        self.max_updates = max_updates
+        self.deadline = time.time() + min(seconds or PROFILE_MAX_SECONDS, PROFILE_MAX_SECONDS)
+        self.notify_chat_id = notify_chat_id
+        self.started_at = time.time()
+        self.updates = 0
+        self.by_handler = {}  # имя -> [вызовов, сумма с, максимум с]
+        self.by_data = {}
+        self.stacks = Counter()
+        self.active_threads = {}  # thread id -> метка обработчика
+        self.lock = Lock()
+        self.stopped = False
+        self.sampler = Thread(target=self.sample_loop, daemon=True)
+
+    def run(self, func, args, kwargs):
+        handler = func.__name__
+        detail = None
+        if args:
+            data = getattr(args[0], 'data', None)
+            text = getattr(args[0], 'text', None)
+            if isinstance(data, str):
+                detail = f"{handler}[{data.split(':')[0]}]"
+            elif isinstance(text, str) and text.startswith('/'):
+                detail = f"{handler}[{text.split()[0]}]"
+
+        thread_id = get_ident()
+        self.active_threads[thread_id] = detail or handler
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.active_threads.pop(thread_id, None)
+            with self.lock:
+                self.updates += 1
+                for stats, key in ((self.by_handler, handler), (self.by_data, detail)):
+                    if key is None:
+                        continue
+                    entry = stats.setdefault(key, [0, 0.0, 0.0])
+                    entry[0] += 1
+                    entry[1] += elapsed
+                    entry[2] = max(entry[2], elapsed)
+                done = self.max_updates is not None and self.updates >= self.max_updates
+            if done:
+                Thread(target=stop_profiling, args=(self,), daemon=True).start()
+
+    def sample_loop(self):
+        while not self.stopped:
+            if time.time() >= self.deadline:
+                Thread(target=stop_profiling, args=(self,), daemon=True).start()
+                return
+            frames = sys._current_frames()
+            for thread_id, label in list(self.active_threads.items()):
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+                stack = []
+                leaf = True
+                while frame is not None:
+                    code = frame.f_code
+                    name = f"{os.path.basename(code.co_filename)}:{code.co_name}"
+                    # Строка только у листа: видно, на каком вызове (SQLite, HTTP) стоит обработчик
+                    stack.append(f"{name}:{frame.f_lineno}" if leaf else name)
+                    leaf = False
+                    frame = frame.f_back
+                stack.append(label)
+                self.stacks[';'.join(reversed(stack))] += 1
+            time.sleep(PROFILE_SAMPLE_INTERVAL)
+
+    def report(self):
+        def rows(stats):
+            return [
+                {"name": key, "calls": calls, "total_ms": round(total * 1000, 1),
+                 "avg_ms": round(total / calls * 1000, 2), "max_ms": round(peak * 1000, 1)}
+                for key, (calls, total, peak) in sorted(stats.items(), key=lambda item: -item[1][1])
+            ]
+        return {
+            "started_at": datetime.fromtimestamp(self.started_at).strftime("%Y-%m-%d %H:%M:%S"),
+            "duration_s": round(time.time() - self.started_at, 1),
+            "updates": self.updates,
+            "samples": sum(self.stacks.values()),
+            "by_handler": rows(self.by_handler),
+            "by_data": rows(self.by_data),
+            "folded": ''.join(f"{stack} {count}\n" for stack, count in self.stacks.most_common()),
+        }
+
+def profiled(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        session = profile_session
+        if session is None:
+            return func(*args, **kwargs)
+        return session.run(func, args, kwargs)
+    return wrapper
+
+def start_profiling(max_updates=None, seconds=None, notify_chat_id=None):
+    global profile_session
+    with profile_lock:
+        if profile_session is not None:
+            return False
+        session = ProfileSession(max_updates, seconds, notify_chat_id)
+        session.sampler.start()
+        profile_session = session
+    logger.info(f"Профилирование запущено: updates={max_updates}, seconds={seconds}")
+    return True
+
+def stop_profiling(session=None):
+    # session передаётся при автоматической остановке, чтобы не остановить уже новую сессию
+    global profile_session, last_profile_report
+    with profile_lock:
+        if profile_session is None or (session is not None and profile_session is not session):
+            return None
+        session = profile_session
+        profile_session = None
+        session.stopped = True
+    report = session.report()
+    last_profile_report = report
+
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, f"profile-{datetime.now().strftime('%Y%m%d-%H%M%S')}.folded")
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(report['folded'])
+        report['path'] = path
+        logger.info(f"Профилирование завершено: {report['updates']} обновлений, стеки в {path}")
+    except Exception as e:
+        logger.error(f"Ошибка записи профиля: {e}")
+
+    if session.notify_chat_id is not None:
+        try:
+            bot.send_message(session.notify_chat_id, format_profile_report(report))
+            if report['folded']:
+                bot.send_document(
+                    session.notify_chat_id,
+                    io.BytesIO(report['folded'].encode('utf-8')),
+                    visible_file_name=os.path.basename(report.get('path', 'profile.folded'))
+                )
+        except Exception as e:
+            logger.error(f"Ошибка отправки профиля: {e}")
+    return report
+
+def format_profile_report(report, limit=10):
+    text = (
+        f"🔬 Профиль: {report['updates']} обновлений за {report['duration_s']} с, "
+        f"сэмплов стека: {report['samples']}\n"
+    )
+    for title, key in (("По обработчикам", 'by_handler'), ("По call.data / командам", 'by_data')):
+        if not report[key]:
+            continue
+        text += f"\n{title}:\n"
+        for row in report[key][:limit]:
+            text += f"{row['name']}: {row['calls']} × {row['avg_ms']} мс (макс {row['max_ms']}, всего {row['total_ms']})\n"
+    return text
+
 # --- Логика бота ---
-@bot.message_handler(commands=['start'])
 def welcome(message):
+    from telebot import types
     markup = types.InlineKeyboardMarkup()
     markup.add(types.InlineKeyboardButton(text="🏠 Главное меню", callback_data='menu_main'))
     bot.send_message(
@@ -356,7 +1897,6 @@ def welcome(message):
         reply_markup=markup
     )
 
-@bot.message_handler(commands=['test_sheets'])
 def test_sheets(message):
     try:
         sheet = get_sheet()
@@ -368,8 +1908,121 @@ def test_sheets(message):
         logger.error(f"Ошибка при тестировании Google Sheets: {str(e)}")
         bot.reply_to(message, f"❌ Ошибка при тестировании: {str(e)}")
 
-@bot.callback_query_handler(func=lambda call: True)
+def reconcile_command(message):
+    if not is_admin(message.from_user.id):
+        return
+    full = 'full' in message.text.split()[1:]
+
+    def run():
+        try:
+            result = reconcile_sheet(full=full)
+            if result is None:
+                bot.reply_to(message, "⏳ Сверка уже выполняется.")
+                return
+            bot.reply_to(
+                message,
+                (
+                    "✅ Сверка завершена\n\n"
+                    f"Проиндексировано строк: {result['indexed']}\n"
+                    f"Листов: {len(result['last_rows'])}\n"
+                    f"Дозаписано ключей: {result['backfilled']}"
+                )
+            )
+        except Exception as e:
+            logger.error(f"Ошибка сверки: {e}")
+            bot.reply_to(message, f"❌ Ошибка сверки: {str(e)}")
+
+    bot.reply_to(message, "⏳ Сверка запущена...")
+    Thread(target=run).start()
+
+def export_command(message):
+    if not is_admin(message.from_user.id):
+        return
+    args = message.text.split()[1:]
+    export_format = args[0] if args else 'csv'
+    if export_format not in EXPORT_FORMATS:
+        bot.reply_to(message, "Использование: /export [csv|ndjson] [YYYY-MM-DD]")
+        return
+    since = args[1] if len(args) > 1 else None
+    generator, _, extension = EXPORT_FORMATS[export_format]
+    try:
+        with tempfile.TemporaryFile() as f:
+            for chunk in generator(since=since):
+                f.write(chunk.encode('utf-8'))
+            f.seek(0)
+            bot.send_document(message.chat.id, f, visible_file_name=f"transactions.{extension}")
+    except Exception as e:
+        logger.error(f"Ошибка выгрузки транзакций: {e}")
+        bot.reply_to(message, f"❌ Ошибка выгрузки: {str(e)}")
+
+def stats_command(message):
+    if not is_admin(message.from_user.id):
+        return
+    args = message.text.split()[1:]
+    days = int(args[0]) if args and args[0].isdigit() else 7
+    days = max(1, min(days, 31))
+    try:
+        bot.reply_to(message, format_sales_stats(get_sales_rollup(days), days))
+    except Exception as e:
+        logger.error(f"Ошибка получения статистики: {e}")
+        bot.reply_to(message, f"❌ Ошибка статистики: {str(e)}")
+
+def profile_command(message):
+    if not is_admin(message.from_user.id):
+        return
+    args = message.text.split()[1:]
+    arg = args[0] if args else '100'
+    if arg == 'stop':
+        if stop_profiling() is None:
+            bot.reply_to(message, "Профилирование не запущено.")
+        return
+
+    # /profile 200 — следующие 200 обновлений, /profile 30s — 30 секунд
+    try:
+        if arg.endswith('s'):
+            max_updates, seconds = None, float(arg[:-1])
+        else:
+            max_updates, seconds = int(arg), None
+        # Ноль, отрицательные значения и nan отклоняем: иначе /profile 0s молча длится PROFILE_MAX_SECONDS
+        if not (max_updates if max_updates is not None else seconds) > 0:
+            raise ValueError(arg)
+    except ValueError:
+        bot.reply_to(message, "Использование: /profile [N | Ts | stop]")
+        return
+    if not start_profiling(max_updates=max_updates, seconds=seconds, notify_chat_id=message.chat.id):
+        bot.reply_to(message, "⏳ Профилирование уже запущено.")
+        return
+    limit = f"{max_updates} обновлений" if max_updates else f"{seconds:g} с"
+    bot.reply_to(message, f"🔬 Профилирование запущено: {limit} (не дольше {PROFILE_MAX_SECONDS} с).")
+
+def publish_command(message):
+    if not is_admin(message.from_user.id):
+        return
+    # /publish <версия> — подписью к документу или ответом на документ;
+    # /publish <версия> <путь> — загрузить файл с диска сервера
+    args = (message.text or message.caption or '').split()[1:]
+    if not args:
+        release = get_current_release()
+        current = f"Текущий выпуск: {release['version']} ({release['file_name']})" if release else "Выпуск не опубликован, выдаётся ссылка."
+        bot.reply_to(message, f"{current}\n\nИспользование: /publish <версия> [путь] — подписью к файлу или ответом на файл")
+        return
+    version = args[0]
+    document = message.document or (message.reply_to_message.document if message.reply_to_message else None)
+    try:
+        if document:
+            release = publish_release(version, document.file_id, document.file_name or RELEASE_FILE_NAME, str(message.from_user.id))
+        elif len(args) > 1:
+            release = upload_release(version, args[1], message.chat.id, str(message.from_user.id))
+        else:
+            bot.reply_to(message, "Прикрепите файл, ответьте на сообщение с файлом или укажите путь.")
+            return
+        bot.reply_to(message, f"✅ Опубликован выпуск {release['version']}: {release['file_name']}")
+    except Exception as e:
+        logger.error(f"Ошибка публикации выпуска {version}: {e}")
+        bot.reply_to(message, f"❌ Ошибка публикации: {str(e)}")
+
 def button_handler(call):
+    from telebot import types
     data = call.data
     chat_id = call.message.chat.id
     message_id = call.message.message_id
@@ -426,28 +2079,13 @@ def button_handler(call):
             reply_markup=markup
         )
 
-    elif data == "menu_licenses":
+    elif data == "menu_licenses" or data.startswith(("lic_next:", "lic_prev:")):
         try:
-            conn = sqlite3.connect('transactions.db')
-            cursor = conn.cursor()
-            cursor.execute("SELECT license_key, timestamp, payment_type FROM transactions WHERE user_id = ? AND status = 'succeeded'",
-                (chat_id,)
-            )
-            results = cursor.fetchall()
-            conn.close()
-
-            markup.add(types.InlineKeyboardButton(text="🔙 Назад в главное меню", callback_data='menu_main'))
-            if results:
-                response = "🔑 *Ваши покупки:*\n\n"
-                for key, timestamp, payment_type in results:
-                    response += (
-                        f"Ключ: `{key}`\n"
-                        f"Дата покупки: {timestamp}\n"
-                        f"Тип: {payment_type.capitalize()}\n\n"
-                    )
+            if data == "menu_licenses":
+                cursor_key, direction = None, 'next'
             else:
-                response = "У вас нет купленных ключей."
-                
+                direction, cursor_key = decode_licenses_cursor(data)
+            response, markup = render_licenses_page(chat_id, cursor_key, direction)
             bot.edit_message_text(
                 response,
                 chat_id=chat_id,
@@ -467,17 +2105,35 @@ def button_handler(call):
                 reply_markup=markup
             )
 
+    elif data == "lic_file":
+        try:
+            if not send_licenses_file(chat_id):
+                bot.answer_callback_query(call.id, "У вас нет купленных ключей.")
+                return
+        except Exception as e:
+            logger.error(f"Ошибка выгрузки лицензий для {chat_id}: {e}")
+            bot.answer_callback_query(call.id, "❌ Не удалось сформировать файл. Свяжитесь с @s3pt1ck.")
+            return
+
     elif data == "menu_pay":
-        markup.add(types.InlineKeyboardButton(text="💸 Оплатить через CryptoBot", callback_data='pay_crypto'))
-        markup.add(types.InlineKeyboardButton(text="💳 Оплатить через YooKassa", callback_data='pay_yookassa'))
+        # Способы оплаты с открытым предохранителем не показываем
+        methods = ""
+        if crypto_breaker.available():
+            markup.add(types.InlineKeyboardButton(text="💸 Оплатить через CryptoBot", callback_data='pay_crypto'))
+            methods += "- *CryptoBot*: Оплата через криптовалюту.\n"
+        if yookassa_breaker.available():
+            markup.add(types.InlineKeyboardButton(text="💳 Оплатить через YooKassa", callback_data='pay_yookassa'))
+            methods += "- *YooKassa*: Оплата картой.\n"
+        if methods:
+            methods = "Выберите способ оплаты:\n" + methods
+        else:
+            methods = "⚠️ Оплата временно недоступна, попробуйте через несколько минут.\n"
         markup.add(types.InlineKeyboardButton(text="🔙 Назад в главное меню", callback_data='menu_main'))
         bot.edit_message_text(
             (
                 f"💳 Информация о покупке\n\n"
                 f"Цена: *{CRYPTO_AMOUNT} TON* или *{YOOKASSA_AMOUNT} RUB* (~$10.7)\n"
-                "Выберите способ оплаты:\n"
-                "- *CryptoBot*: Оплата через криптовалюту.\n"
-                "- *YooKassa*: Оплата картой.\n\n"
+                f"{methods}\n"
                 "Ключ и ссылка будут отправлены после оплаты."
             ),
             chat_id=chat_id,
@@ -522,21 +2178,22 @@ def button_handler(call):
 
             invoice_id = invoice["invoice_id"]
             pay_url = invoice["pay_url"]
-            invoices[chat_id] = {
+            set_pending_invoice(chat_id, {
                 'invoice_id': invoice_id,
                 'username': username,
                 'payment_type': 'crypto',
                 'created_at': time.time()
-            }
+            })
             logger.info(f"Инвойс создан: invoice_id={invoice_id}, pay_url={pay_url}")
 
             # Сохраняем инвойс в базе
-            conn = sqlite3.connect('transactions.db')
+            conn = sqlite3.connect(DB_FILE)
             cursor = conn.cursor()
             cursor.execute('''
                 INSERT INTO transactions (payment_id, user_id, username, timestamp, payment_type, status)
                 VALUES (?, ?, ?, ?, ?, ?)
             ''', (invoice_id, chat_id, username, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 'crypto', 'pending'))
+            bump_sales_rollup(cursor, 'crypto', 'pending')
             conn.commit()
             conn.close()
 
@@ -612,21 +2269,22 @@ def button_handler(call):
 
             payment_id = payment.id
             confirmation_url = payment.confirmation.confirmation_url
-            invoices[chat_id] = {
+            set_pending_invoice(chat_id, {
                 'payment_id': payment_id,
                 'username': username,
                 'payment_type': 'yookassa',
                 'created_at': time.time()
-            }
+            })
             logger.info(f"YooKassa платеж создан: payment_id={payment_id}")
 
             # Сохраняем платеж в базе
-            conn = sqlite3.connect('transactions.db')
+            conn = sqlite3.connect(DB_FILE)
             cursor = conn.cursor()
             cursor.execute('''
                 INSERT INTO transactions (payment_id, user_id, username, timestamp, payment_type, status)
                 VALUES (?, ?, ?, ?, ?, ?)
             ''', (payment_id, chat_id, username, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 'yookassa', 'pending'))
+            bump_sales_rollup(cursor, 'yookassa', 'pending')
             conn.commit()
             conn.close()
 
@@ -662,7 +2320,8 @@ def button_handler(call):
             )
 
     elif data == "pay_verify":
-        if chat_id not in invoices:
+        invoice = get_pending_invoice(chat_id)
+        if invoice is None:
             markup.add(types.InlineKeyboardButton(text="🔙 Назад к способам оплаты", callback_data='menu_pay'))
             bot.edit_message_text(
                 (
@@ -676,8 +2335,15 @@ def button_handler(call):
             )
             return
 
-        payment_type = invoices[chat_id]['payment_type']
-        username = invoices[chat_id]['username']
+        payment_type = invoice['payment_type']
+        username = invoice['username']
+
+        # Одна проверка на пользователя во всех экземплярах: повторный клик не выдаст второй ключ
+        verify_lock = f"verify:{chat_id}"
+        lock_owner = f"{INSTANCE_ID}:{uuid4()}"
+        if not state.acquire(verify_lock, lock_owner, VERIFY_LOCK_TTL):
+            bot.answer_callback_query(call.id, "⏳ Проверка уже выполняется, подождите.")
+            return
 
         try:
             markup.add(types.InlineKeyboardButton(text="🔙 Назад к способам оплаты", callback_data='menu_pay'))
@@ -689,11 +2355,11 @@ def button_handler(call):
                 reply_markup=markup
             )
 
-            conn = sqlite3.connect('transactions.db')
+            conn = sqlite3.connect(DB_FILE)
             cursor = conn.cursor()
 
             if payment_type == 'crypto':
-                invoice_id = invoices[chat_id]['invoice_id']
+                invoice_id = invoice['invoice_id']
                 status = check_invoice_status(invoice_id)
                 if status == "paid":
                     cursor.execute("SELECT license_key FROM transactions WHERE payment_id = ?", (invoice_id,))
@@ -706,7 +2372,7 @@ def button_handler(call):
                             (
                                 "🎉 *Платеж уже обработан!*\n\n"
                                 f"HWID-ключ:\n`{result[0]}`\n\n"
-                                f"Скачать приложение Valture:\n[VALTURE.exe]({APP_DOWNLOAD_URL})\n\n"
+                                f"{app_download_text()}\n\n"
                                 "Сохраните ключ и скачайте приложение! 🚀"
                             ),
                             chat_id=chat_id,
@@ -715,15 +2381,24 @@ def button_handler(call):
                             reply_markup=markup,
                             disable_web_page_preview=True
                         )
+                        send_app_release(chat_id)
                         conn.close()
                         return
 
                     hwid_key = generate_license()
-                    sheet_success = append_license_to_sheet(hwid_key, username)
                     cursor.execute('''
                         UPDATE transactions SET license_key = ?, status = ? WHERE payment_id = ?
                     ''', (hwid_key, 'succeeded', invoice_id))
+                    # Ожидающая оплата общая для экземпляров, а строка платежа — в локальной базе.
+                    # Несохранённый ключ не пройдёт /api/license/validate, поэтому не показываем его.
+                    if cursor.rowcount != 1:
+                        conn.rollback()
+                        conn.close()
+                        raise RuntimeError(f"Платеж {invoice_id} не найден в {DB_FILE}, ключ не сохранён")
+                    bump_sales_rollup(cursor, 'crypto', 'succeeded')
                     conn.commit()
+                    index_license(hwid_key, username)
+                    sheet_success = append_license_to_sheet(hwid_key, username)
                     markup = types.InlineKeyboardMarkup()
                     markup.add(types.InlineKeyboardButton(text="🏠 Назад в главное меню", callback_data='menu_main'))
                     if sheet_success:
@@ -731,7 +2406,7 @@ def button_handler(call):
                             (
                                 "🎉 *Поздравляем с покупкой!*\n\n"
                                 f"HWID-ключ:\n`{hwid_key}`\n\n"
-                                f"Скачать приложение Valture:\n[VALTURE.exe]({APP_DOWNLOAD_URL})\n\n"
+                                f"{app_download_text()}\n\n"
                                 "Сохраните ключ и скачайте приложение! 🚀"
                             ),
                             chat_id=chat_id,
@@ -745,7 +2420,7 @@ def button_handler(call):
                             (
                                 "🎉 *Поздравляем с покупкой!*\n\n"
                                 f"HWID-ключ:\n`{hwid_key}`\n\n"
-                                f"Скачать приложение Valture:\n[VALTURE.exe]({APP_DOWNLOAD_URL})\n\n"
+                                f"{app_download_text()}\n\n"
                                 "Сохраните ключ и скачайте приложение! 🚀\n\n"
                                 "⚠️ Не удалось записать ключ в таблицу. Свяжитесь с @s3pt1ck."
                             ),
@@ -755,16 +2430,25 @@ def button_handler(call):
                             reply_markup=markup,
                             disable_web_page_preview=True
                         )
+                    send_app_release(chat_id)
                     logger.info(f"CryptoBot оплата подтверждена: {hwid_key} для {username}")
-                    del invoices[chat_id]
+                    clear_pending_invoice(chat_id)
                 else:
                     markup.add(types.InlineKeyboardButton(text="🔄 Проверить снова", callback_data='pay_verify'))
                     markup.add(types.InlineKeyboardButton(text="🔙 Назад к способам оплаты", callback_data='menu_pay'))
-                    bot.edit_message_text(
-                        (
+                    if status is None and not crypto_breaker.available():
+                        text = (
+                            "⚠️ *CryptoBot временно недоступен*\n\n"
+                            "Не удалось проверить оплату. Если вы уже оплатили, ключ не потеряется — "
+                            "проверьте снова через несколько минут."
+                        )
+                    else:
+                        text = (
                             "⏳ *Оплата еще не подтверждена*\n\n"
                             "Завершите оплату или попробуйте снова. Свяжитесь с @s3pt1ck."
-                        ),
+                        )
+                    bot.edit_message_text(
+                        text,
                         chat_id=chat_id,
                         message_id=message_id,
                         parse_mode="Markdown",
@@ -772,7 +2456,7 @@ def button_handler(call):
                     )
 
             elif payment_type == 'yookassa':
-                payment_id = invoices[chat_id]['payment_id']
+                payment_id = invoice['payment_id']
                 status = check_yookassa_payment_status(payment_id)
                 if status == "succeeded":
                     cursor.execute("SELECT license_key FROM transactions WHERE payment_id = ?", (payment_id,))
@@ -785,7 +2469,7 @@ def button_handler(call):
                             (
                                 "🎉 *Платеж уже обработан!*\n\n"
                                 f"HWID-ключ:\n`{result[0]}`\n\n"
-                                f"Скачать приложение Valture:\n[VALTURE.exe]({APP_DOWNLOAD_URL})\n\n"
+                                f"{app_download_text()}\n\n"
                                 "Сохраните ключ и скачайте приложение! 🚀"
                             ),
                             chat_id=chat_id,
@@ -794,15 +2478,24 @@ def button_handler(call):
                             reply_markup=markup,
                             disable_web_page_preview=True
                         )
+                        send_app_release(chat_id)
                         conn.close()
                         return
 
                     hwid_key = generate_license()
-                    sheet_success = append_license_to_sheet(hwid_key, username)
                     cursor.execute('''
                         UPDATE transactions SET license_key = ?, status = ? WHERE payment_id = ?
                     ''', (hwid_key, 'succeeded', payment_id))
+                    # Ожидающая оплата общая для экземпляров, а строка платежа — в локальной базе.
+                    # Несохранённый ключ не пройдёт /api/license/validate, поэтому не показываем его.
+                    if cursor.rowcount != 1:
+                        conn.rollback()
+                        conn.close()
+                        raise RuntimeError(f"Платеж {payment_id} не найден в {DB_FILE}, ключ не сохранён")
+                    bump_sales_rollup(cursor, 'yookassa', 'succeeded')
                     conn.commit()
+                    index_license(hwid_key, username)
+                    sheet_success = append_license_to_sheet(hwid_key, username)
                     markup = types.InlineKeyboardMarkup()
                     markup.add(types.InlineKeyboardButton(text="🏠 Назад в главное меню", callback_data='menu_main'))
                     if sheet_success:
@@ -810,7 +2503,7 @@ def button_handler(call):
                             (
                                 "🎉 *Поздравляем с покупкой!*\n\n"
                                 f"HWID-ключ:\n`{hwid_key}`\n\n"
-                                f"Скачать приложение Valture:\n[VALTURE.exe]({APP_DOWNLOAD_URL})\n\n"
+                                f"{app_download_text()}\n\n"
                                 "Сохраните ключ и скачайте приложение! 🚀"
                             ),
                             chat_id=chat_id,
@@ -824,7 +2517,7 @@ def button_handler(call):
                             (
                                 "🎉 *Поздравляем с покупкой!*\n\n"
                                 f"HWID-ключ:\n`{hwid_key}`\n\n"
-                                f"Скачать приложение Valture:\n[VALTURE.exe]({APP_DOWNLOAD_URL})\n\n"
+                                f"{app_download_text()}\n\n"
                                 "Сохраните ключ и скачайте приложение! 🚀\n\n"
                                 "⚠️ Не удалось записать ключ в таблицу. Свяжитесь с @s3pt1ck."
                             ),
@@ -834,16 +2527,25 @@ def button_handler(call):
                             reply_markup=markup,
                             disable_web_page_preview=True
                         )
+                    send_app_release(chat_id)
                     logger.info(f"YooKassa оплата подтверждена: {hwid_key} для {username}")
-                    del invoices[chat_id]
+                    clear_pending_invoice(chat_id)
                 else:
                     markup.add(types.InlineKeyboardButton(text="🔄 Проверить снова", callback_data='pay_verify'))
                     markup.add(types.InlineKeyboardButton(text="🔙 Назад к способам оплаты", callback_data='menu_pay'))
-                    bot.edit_message_text(
-                        (
+                    if status is None and not yookassa_breaker.available():
+                        text = (
+                            "⚠️ *YooKassa временно недоступен*\n\n"
+                            "Не удалось проверить оплату. Если вы уже оплатили, ключ не потеряется — "
+                            "проверьте снова через несколько минут."
+                        )
+                    else:
+                        text = (
                             "⏳ *Оплата еще не подтверждена*\n\n"
                             "Завершите оплату или попробуйте снова. Свяжитесь с @s3pt1ck."
-                        ),
+                        )
+                    bot.edit_message_text(
+                        text,
                         chat_id=chat_id,
                         message_id=message_id,
                         parse_mode="Markdown",
@@ -866,6 +2568,8 @@ def button_handler(call):
                 parse_mode="Markdown",
                 reply_markup=markup
             )
+        finally:
+            state.release(verify_lock, lock_owner)
 
     elif data == "menu_faq":
         markup.add(types.InlineKeyboardButton(text="🔙 Назад в главное меню", callback_data='menu_main'))
@@ -900,8 +2604,94 @@ def button_handler(call):
 
     bot.answer_callback_query(call.id)
 
+# --- Сборка приложения ---
+def create_bot():
+    import telebot
+    if TELEGRAM_API_URL:
+        telebot.apihelper.API_URL = TELEGRAM_API_URL
+    telegram_bot = telebot.TeleBot(TOKEN)
+    telegram_bot.register_message_handler(profiled(welcome), commands=['start'])
+    telegram_bot.register_message_handler(profiled(test_sheets), commands=['test_sheets'])
+    telegram_bot.register_message_handler(reconcile_command, commands=['reconcile'])
+    telegram_bot.register_message_handler(export_command, commands=['export'])
+    telegram_bot.register_message_handler(stats_command, commands=['stats'])
+    telegram_bot.register_message_handler(profile_command, commands=['profile'])
+    telegram_bot.register_message_handler(publish_command, commands=['publish'])
+    telegram_bot.register_message_handler(
+        publish_command, content_types=['document'],
+        func=lambda message: (message.caption or '').startswith('/publish')
+    )
+    telegram_bot.register_callback_query_handler(profiled(button_handler), func=lambda call: True)
+    return telegram_bot
+
+def setup_logging():
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.DEBUG
+    )
+
+def create_application():
+    # Вся инициализация явная: импорт модуля не трогает БД, сеть и потоки
+    global app, bot, state
+    setup_logging()
+    init_db()
+    state = create_state_backend()
+    bot = create_bot()
+    app = create_app()
+    return bot, app
+
+def start_background_jobs():
+    Thread(target=leader_loop, daemon=True).start()
+
+def warm_up_dependencies():
+    # Импорт SDK и подключение к таблице заранее, чтобы первый платёж не ждал их
+    started = time.perf_counter()
+    try:
+        importlib.import_module("requests")
+        get_yookassa_payment()
+        get_sheet()
+    except Exception as e:
+        logger.warning(f"Прогрев зависимостей не завершён: {e}")
+    logger.info(f"Прогрев зависимостей: {time.perf_counter() - started:.2f} с")
+
 if __name__ == '__main__':
+    # python main.py reconcile [--full] — разовая сверка без запуска бота
+    if len(sys.argv) > 1 and sys.argv[1] == 'reconcile':
+        setup_logging()
+        init_db()
+        print(reconcile_sheet(full='--full' in sys.argv[2:]))
+        sys.exit(0)
+    # python main.py archive — разовый перенос устаревших платежей в архив;
+    # при первом запуске переводит базу в auto_vacuum=INCREMENTAL полным VACUUM
+    if len(sys.argv) > 1 and sys.argv[1] == 'archive':
+        setup_logging()
+        init_db()
+        print(archive_stale_transactions(convert_vacuum=True))
+        sys.exit(0)
+
+    create_application()
+    # Новые привязки HWID ждут импорта колонки B: делаем его до приёма запросов
+    if not hwid_import_done():
+        try:
+            reconcile_sheet()
+        except Exception as e:
+            logger.error(f"Импорт HWID из таблицы не выполнен, новые привязки отложены: {e}")
+    start_background_jobs()
+    # Прогрев стартует после запуска polling/сервера: они блокируют поток
+    warmup = Timer(WARMUP_DELAY, warm_up_dependencies)
+    warmup.daemon = True
+    warmup.start()
+
+    if TELEGRAM_WEBHOOK_URL:
+        # Режим нескольких экземпляров: обновления приходят на /telegram-webhook любого из них
+        bot.set_webhook(url=f"{TELEGRAM_WEBHOOK_URL.rstrip('/')}/telegram-webhook", secret_token=TELEGRAM_WEBHOOK_SECRET)
+        logger.info(f"Бот запущен (вебхук), экземпляр {INSTANCE_ID}")
+        run_flask()
+        sys.exit(0)
+
     Thread(target=run_flask).start()
+    # Вебхук, оставшийся от режима нескольких экземпляров, блокирует getUpdates
+    bot.remove_webhook()
     logger.info("Бот запущен")
     try:
         bot.polling(non_stop=True)
@@ -0,0 +1,160 @@
+# Предохранители внешних сервисов: CryptoBot на локальной заглушке с внедрёнными сбоями.
+# Запуск из корня репозитория: python -m pytest tests
+import json
+import os
+import sys
+import threading
+import time
+import types
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+OPEN_SECONDS = 0.3
+
+
+class StubCryptoBot(BaseHTTPRequestHandler):
+    # Режим задаётся классом: ok, error (HTTP 500), bad_request (HTTP 400) или slow (таймаут)
+    mode = "ok"
+
+    def respond(self, payload):
+        if self.mode == "slow":
+            time.sleep(main.CRYPTO_BOT_TIMEOUT * 3)
+        status = {"error": 500, "bad_request": 400}.get(self.mode, 200)
+        body = json.dumps(payload if status == 200 else {"ok": False, "error": self.mode}).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except OSError:
+            pass  # клиент уже отвалился по таймауту
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.respond({"ok": True, "result": {"invoice_id": 1, "pay_url": "http://stub/pay"}})
+
+    def do_GET(self):
+        self.respond({"ok": True, "result": {"items": [{"status": "paid"}]}})
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubCryptoBot)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(StubCryptoBot, "mode", "ok")
+    monkeypatch.setattr(main, "CRYPTO_BOT_API", f"http://127.0.0.1:{server.server_port}")
+    monkeypatch.setattr(main, "CRYPTOBOT_API_TOKEN", "stub")
+    monkeypatch.setattr(main, "CRYPTO_BOT_TIMEOUT", 0.2)
+    monkeypatch.setattr(main, "crypto_breaker", main.CircuitBreaker(
+        "crypto", window=10, min_calls=4, failure_rate=0.5, open_seconds=OPEN_SECONDS
+    ))
+    yield StubCryptoBot
+    server.shutdown()
+    server.server_close()
+
+
+def set_mode(stub, monkeypatch, mode):
+    monkeypatch.setattr(stub, "mode", mode)
+
+
+def test_breaker_opens_half_opens_and_closes(stub, monkeypatch):
+    breaker = main.crypto_breaker
+    assert main.create_crypto_invoice(4.0)[0] is not None
+
+    # 5xx и таймауты считаются сбоями: после min_calls вызовов с долей ошибок ≥ 50% — open
+    for mode in ("error", "slow"):
+        set_mode(stub, monkeypatch, mode)
+        assert main.check_invoice_status(1) is None
+        assert breaker.state == "closed"
+    set_mode(stub, monkeypatch, "error")
+    assert main.check_invoice_status(1) is None
+    assert breaker.state == "open"
+    assert breaker.counters["failure"] == 3
+
+    # Открытый предохранитель отвечает сразу, не обращаясь к сервису
+    set_mode(stub, monkeypatch, "ok")
+    started = time.perf_counter()
+    invoice, error = main.create_crypto_invoice(4.0)
+    assert invoice is None and error == main.SERVICE_UNAVAILABLE_ERROR
+    assert time.perf_counter() - started < 0.05
+    assert breaker.counters["rejected"] == 1
+
+    # После паузы один пробный вызов; неудачный снова открывает предохранитель
+    time.sleep(OPEN_SECONDS)
+    set_mode(stub, monkeypatch, "error")
+    assert main.check_invoice_status(1) is None
+    assert breaker.state == "open"
+
+    time.sleep(OPEN_SECONDS)
+    set_mode(stub, monkeypatch, "ok")
+    assert main.check_invoice_status(1) == "paid"
+    assert breaker.state == "closed"
+
+
+def test_lost_half_open_trial_is_rearmed(stub):
+    breaker = main.crypto_breaker
+    breaker.trip()
+    time.sleep(OPEN_SECONDS)
+    # Пробный вызов так и не сообщил результат
+    assert breaker.allow() is True
+    assert breaker.state == "half_open"
+    assert breaker.allow() is False
+
+    time.sleep(OPEN_SECONDS)
+    assert main.check_invoice_status(1) == "paid"
+    assert breaker.state == "closed"
+
+
+def test_client_errors_do_not_open_breaker(stub, monkeypatch):
+    set_mode(stub, monkeypatch, "bad_request")
+    for _ in range(10):
+        invoice, _ = main.create_crypto_invoice(4.0)
+        assert invoice is None
+    assert main.crypto_breaker.state == "closed"
+    assert main.crypto_breaker.counters["failure"] == 0
+
+
+class RecordingBot:
+    def __init__(self):
+        self.markups = []
+
+    def edit_message_text(self, text, reply_markup=None, **kwargs):
+        self.markups.append(reply_markup)
+
+    def answer_callback_query(self, *args, **kwargs):
+        pass
+
+
+def menu_pay_buttons(monkeypatch):
+    bot = RecordingBot()
+    monkeypatch.setattr(main, "bot", bot)
+    call = types.SimpleNamespace(
+        data="menu_pay",
+        message=types.SimpleNamespace(chat=types.SimpleNamespace(id=1), message_id=1),
+        id="callback",
+        from_user=types.SimpleNamespace(id=1, username="user", first_name="user"),
+    )
+    main.button_handler(call)
+    return {button.callback_data for row in bot.markups[-1].keyboard for button in row}
+
+
+def test_menu_pay_hides_crypto_while_breaker_is_open(stub, monkeypatch):
+    assert "pay_crypto" in menu_pay_buttons(monkeypatch)
+
+    main.crypto_breaker.trip()
+    buttons = menu_pay_buttons(monkeypatch)
+    assert "pay_crypto" not in buttons
+    assert "pay_yookassa" in buttons
+
+    time.sleep(OPEN_SECONDS)
+    assert "pay_crypto" in menu_pay_buttons(monkeypatch)
@@ -0,0 +1,92 @@
+# Архивирование устаревших платежей: выданные лицензии не должны попадать в архив.
+# Запуск из корня репозитория: python -m pytest tests
+import os
+import sqlite3
+import sys
+from datetime import datetime, timedelta
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+NOW = datetime(2026, 1, 31, 12, 0, 0)
+OLD = (NOW - timedelta(days=400)).strftime("%Y-%m-%d %H:%M:%S")
+FRESH = (NOW - timedelta(days=1)).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def seed(db_file):
+    rows = []
+    for i in range(50):
+        rows.append((f"succ-{i}", "1", "u", f"KEY{i:029d}", OLD, "crypto", "succeeded"))
+        # Ключ выдан, но статус не обновился (сбой между записью ключа и статуса)
+        rows.append((f"keyed-{i}", "1", "u", f"PKEY{i:028d}", OLD, "crypto", "pending"))
+        rows.append((f"pend-{i}", "1", "u", None, OLD, "crypto", "pending"))
+        rows.append((f"canc-{i}", "1", "u", None, OLD, "yookassa", "canceled"))
+        rows.append((f"fresh-{i}", "1", "u", None, FRESH, "crypto", "pending"))
+    conn = sqlite3.connect(db_file)
+    conn.executemany(
+        "INSERT INTO transactions (payment_id, user_id, username, license_key, timestamp, payment_type, status) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        rows
+    )
+    conn.commit()
+    conn.close()
+
+
+@pytest.fixture(params=["same_db", "archive_db"])
+def databases(request, tmp_path, monkeypatch):
+    db_file = str(tmp_path / "transactions.db")
+    archive_file = str(tmp_path / "archive.db") if request.param == "archive_db" else None
+    monkeypatch.setattr(main, "DB_FILE", db_file)
+    monkeypatch.setattr(main, "ARCHIVE_DB_FILE", archive_file)
+    main.init_db()
+    seed(db_file)
+    return db_file, archive_file or db_file
+
+
+def test_succeeded_and_keyed_rows_are_never_archived(databases):
+    db_file, archive_file = databases
+    retention = {'pending': 7, 'canceled': 30, 'succeeded': 1}
+    result = main.archive_stale_transactions(retention=retention, batch=7, now=NOW, convert_vacuum=True)
+    assert result['moved'] == {'pending': 50, 'canceled': 50}
+
+    conn = sqlite3.connect(db_file)
+    remaining = {row[0] for row in conn.execute("SELECT payment_id FROM transactions")}
+    conn.close()
+    for i in range(50):
+        assert f"succ-{i}" in remaining
+        assert f"keyed-{i}" in remaining
+        assert f"fresh-{i}" in remaining
+
+    conn = sqlite3.connect(archive_file)
+    archived = conn.execute(
+        "SELECT COUNT(*), SUM(status = 'succeeded'), SUM(license_key IS NOT NULL) FROM transactions_archive"
+    ).fetchone()
+    conn.close()
+    assert archived == (100, 0, 0)
+
+
+def test_scheduled_run_does_not_vacuum_legacy_database(tmp_path, monkeypatch):
+    db_file = str(tmp_path / "legacy.db")
+    conn = sqlite3.connect(db_file)
+    # База, созданная до появления auto_vacuum: режим уже не меняется без VACUUM
+    conn.execute("PRAGMA auto_vacuum = NONE")
+    conn.execute("CREATE TABLE legacy (id INTEGER)")
+    conn.commit()
+    conn.close()
+    monkeypatch.setattr(main, "DB_FILE", db_file)
+    monkeypatch.setattr(main, "ARCHIVE_DB_FILE", None)
+    main.init_db()
+    seed(db_file)
+
+    main.archive_stale_transactions(now=NOW)
+    conn = sqlite3.connect(db_file)
+    assert conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 0
+    conn.close()
+
+    main.archive_stale_transactions(now=NOW, convert_vacuum=True)
+    conn = sqlite3.connect(db_file)
+    assert conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+    conn.close()